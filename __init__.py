@@ -23,7 +23,7 @@ bl_info = {
   "category" : "Render"
 }
 
-import tempfile
+from types import SimpleNamespace
 import bpy
 from bpy.props import (StringProperty,
                        PointerProperty,
@@ -33,26 +33,60 @@ from bpy.props import (StringProperty,
                        FloatProperty,
                        FloatVectorProperty)
 from bpy.types import PropertyGroup
-from . nxpreview_op import OBJECT_OT_NXPreview
+from . nxcache import managed_cache_dir
+from . nxqueue import register_handlers, unregister_handlers
+from . nxwriter import library_writer
+from . nxrelight import relight_preview
+from . nxlive import live_preview
+from . import nxstats
+from . import nxbase_op
+from . nxpreview_op import (OBJECT_OT_NXPreview,
+                            OBJECT_OT_NXPreviewBatch,
+                            OBJECT_OT_NXPreviewQueue,
+                            OBJECT_OT_NXQueuePause,
+                            OBJECT_OT_NXQueueCancel,
+                            OBJECT_OT_NXStageClear,
+                            OBJECT_OT_NXPurgeOrphans,
+                            OBJECT_OT_NXResourcesReload,
+                            OBJECT_OT_NXRelight,
+                            OBJECT_OT_NXLivePreview,
+                            OBJECT_OT_NXCacheClean)
 from . nxasset_op import (ASSET_OT_NXAssetToggle,
                           ASSET_OT_NXAssetSave,
+                          ASSET_OT_NXAssetExport,
+                          ASSET_OT_NXLibrarySync,
                           ASSET_OT_NXLibraryAdd,
                           ASSET_OT_NXLibraryRemove)
-from . nxpreview_UI import (PREFERENCE_UL_asset_library,
+from . nxpreview_UI import (set_operator_settings,
+                            PREFERENCE_UL_asset_library,
                             NXPREVIEW_PT_control_panel,
                             NXPREVIEW_PT_Background,
                             NXPREVIEW_PT_Lighting,
                             NXPREVIEW_PT_Camera,
+                            NXPREVIEW_PT_Render,
                             NXPREVIEW_PT_Output,
+                            NXPREVIEW_PT_Stats,
                             NXPREVIEW_PT_SaveAsset)
                             
+def update_live(self, context):
+  '''Request the live preview of the active mesh, rendered when the settings stop changing'''
+  obj = context.object
+  if not self.use_live_preview or obj is None or obj.type != 'MESH':
+    return
+  settings = SimpleNamespace()
+  set_operator_settings(settings, self)
+  live_preview.request(dict(vars(settings), original_scene=context.scene.name, 
+                            original_object=obj.name))
+
 def update_backdrop(self, context):
   if self.use_backdrop:
     self.use_background = False
+  update_live(self, context)
 
 def update_background(self, context):
   if self.use_background:
     self.use_backdrop = False  
+  update_live(self, context)
 
 def update_library_id(self, context):
   id = self.library_id
@@ -70,12 +104,17 @@ def update_library_id(self, context):
 
   self.last_library_id = self.library_id
 
-tempD = tempfile.gettempdir()
+def update_relight(self, context):
+  if self.use_relight and context.object is not None:
+    relight_preview(context.object, self)
+  update_live(self, context)
+
+tempD = managed_cache_dir()
 
 class MXPreviewProperties(PropertyGroup):
   path : StringProperty(
       name="path",
-      description=f"Path to preview output.\nLet empty to save in tempdir: {tempD}",
+      description=f"Path to preview output.\nLet empty to save in the preview cache: {tempD}",
       default="",
       maxlen=1024,
       subtype='DIR_PATH'
@@ -104,7 +143,13 @@ class MXPreviewProperties(PropertyGroup):
         ('LIGHT', 'light', 'Light'),
         ('DARK', 'dark', 'Dark')
       },
-      default="NEUTRAL"
+      default="NEUTRAL",
+      update=update_live
+  )
+  backdrop_variants : BoolProperty(
+    name="Style Variants",
+    description="Write also the preview with the light, neutral and dark backdrops, from the same render",
+    default=False
   )
   use_background : BoolProperty(
     name="use_background",
@@ -119,7 +164,27 @@ class MXPreviewProperties(PropertyGroup):
     default=(0.25,0.25,0.25),
     min=0,
     max=1,
-    size=3
+    size=3,
+    update=update_live
+  )
+  background_compositing : EnumProperty(
+      name="Compositing",
+      description="How the background is added to the transparent render",
+      items=[
+        ('COMPOSITOR', 'Compositor', 'Mix node of the compositor'),
+        ('NUMPY', 'NumPy', 'Alpha-over of the rendered pixels, without compositor')
+      ],
+      default="COMPOSITOR"
+  )
+  background_variants : BoolProperty(
+    name="Background Variants",
+    description="Write also the preview without background and over neutral, light and dark backgrounds, from the same render",
+    default=False
+  )
+  use_relight : BoolProperty(
+    name="Relight Passes",
+    description="Render the passes of each light and of the world (Cycles, Blender 3.2+).\nThe strengths change the preview of the object without render",
+    default=False
   )
   show_lighting : BoolProperty(
     name="Show Lighting",
@@ -132,7 +197,8 @@ class MXPreviewProperties(PropertyGroup):
     default=0.5,
     min=0,
     max=1,
-    step=10
+    step=10,
+    update=update_relight
   )
   light_top_strength : FloatProperty(
     name="Light Top Strength",
@@ -140,7 +206,8 @@ class MXPreviewProperties(PropertyGroup):
     default=0.5,
     min=0,
     max=1,
-    step=10
+    step=10,
+    update=update_relight
   )
   light_left_strength : FloatProperty(
     name="Light Left Strength",
@@ -148,7 +215,8 @@ class MXPreviewProperties(PropertyGroup):
     default=0.5,
     min=0,
     max=1,
-    step=10
+    step=10,
+    update=update_relight
   )
   light_right_strength : FloatProperty(
     name="Light Right Strength",
@@ -156,14 +224,16 @@ class MXPreviewProperties(PropertyGroup):
     default=0.5,
     min=0,
     max=1,
-    step=10
+    step=10,
+    update=update_relight
   )
   camera_focal : IntProperty(
     name="Camera Focal",
     description="Adjust the focal length",
     default=85,
     min=24,
-    max=250
+    max=250,
+    update=update_live
   )
   camera_align_h : EnumProperty(
       name="Horizontal Alignement",
@@ -173,7 +243,8 @@ class MXPreviewProperties(PropertyGroup):
         ('CENTER', 'center', 'Center'),
         ('RIGHT', 'right', 'Right')
       },
-      default="RIGHT"
+      default="RIGHT",
+      update=update_live
   )
   camera_align_v : EnumProperty(
       name="Vertical Alignement",
@@ -183,7 +254,31 @@ class MXPreviewProperties(PropertyGroup):
         ('CENTER', 'center', 'Center'),
         ('BOTTOM', 'bottom', 'Bottom')
       },
-      default="CENTER"
+      default="CENTER",
+      update=update_live
+  )
+  use_live_preview : BoolProperty(
+    name="Live Preview",
+    description="Show a low resolution render of the preview, updated when the settings change",
+    default=False,
+    update=update_live
+  )
+  multi_view : EnumProperty(
+      name="Multi-View",
+      description="Render also the object turned around it",
+      items=[
+        ('NONE', 'None', 'Only the preview'),
+        ('SEQUENCE', 'Image Sequence', 'An image by view, named object_00, object_01...'),
+        ('SHEET', 'Contact Sheet', 'All the views in one image, named object_sheet')
+      ],
+      default="NONE"
+  )
+  view_count : IntProperty(
+    name="Views",
+    description="Number of views, the object is turned by 360 / views degrees between them",
+    default=8,
+    min=2,
+    max=64
   )
   save_in_file_folder : BoolProperty(
     name="Save in File Folder",
@@ -208,6 +303,124 @@ class MXPreviewProperties(PropertyGroup):
     description="Apply all modifiers before save asset in library",
     default=False
   )
+  export_layout : EnumProperty(
+      name="Layout",
+      description="Files of the library written by a batch",
+      items=[
+        ('ASSET', 'One File by Asset', 'A file named as the object for each asset'),
+        ('CATALOG', 'By Catalog', 'A file for the assets of each catalog'),
+        ('COLLECTION', 'By Collection', 'A file for the assets of each collection'),
+        ('SINGLE', 'Single File', 'All the assets in one file')
+      ],
+      default="ASSET"
+  )
+  export_file_name : StringProperty(
+    name="File Name",
+    description="Name of the .blend file of the library, without extension",
+    default="assets"
+  )
+  sync_library : BoolProperty(
+    name="Sync Library",
+    description="A batch saves all the new or changed assets of the file, the unchanged files of the library are not written",
+    default=False
+  )
+  stage_mode : EnumProperty(
+      name="Staging",
+      description="How the object is put on the preview stage",
+      items=[
+        ('COPY', 'Copy', 'Render a copy of the mesh with the modifiers applied'),
+        ('LINK', 'Link', 'Render the original mesh and modifiers, without copy.\nLess memory for the high poly objects')
+      ],
+      default="COPY"
+  )
+  stats_path : StringProperty(
+    name="Stats Log",
+    description="Write the time of each stage by asset in this file, JSON or CSV (.csv)",
+    default="",
+    maxlen=1024,
+    subtype='FILE_PATH'
+  )
+  save_preview_file : BoolProperty(
+    name="Save Preview File",
+    description="Save the preview as PNG file.\nDisabled, the rendered pixels are assigned directly to the asset",
+    default=True
+  )
+  use_cache : BoolProperty(
+    name="Use Cache",
+    description="Skip the render if the object, its materials and the settings didn't change since the last preview",
+    default=True
+  )
+  cache_max_size : IntProperty(
+    name="Cache Size",
+    description="Maximum size of the preview cache in MB, the least recently used previews are removed.\n0 for no limit",
+    default=1024,
+    min=0
+  )
+  cache_max_days : IntProperty(
+    name="Cache Days",
+    description="Remove the previews of the cache not used since this number of days.\n0 for no limit",
+    default=30,
+    min=0
+  )
+  render_profile : EnumProperty(
+      name="Render Profile",
+      description="Choose render engine and quality",
+      items=[
+        ('EEVEE', 'EEVEE', 'Default EEVEE render, needs a GPU'),
+        ('DRAFT', 'Draft', 'Cycles CPU, 16 samples, denoised. Fast thumbnails'),
+        ('STANDARD', 'Standard', 'Cycles CPU, 64 samples, denoised'),
+        ('FINAL', 'Final', 'Cycles CPU, 256 samples, denoised')
+      ],
+      default="EEVEE"
+  )
+  render_threads : IntProperty(
+    name="Threads",
+    description="Number of render threads.\n0 to use all the cores",
+    default=0,
+    min=0,
+    max=1024
+  )
+  resolution : IntProperty(
+    name="Resolution",
+    description="Width and height of the preview in pixels",
+    default=512,
+    min=16,
+    max=4096,
+    subtype='PIXEL'
+  )
+  resolution_percentage : IntProperty(
+    name="Resolution %",
+    description="Percentage of the resolution rendered",
+    default=100,
+    min=1,
+    max=100,
+    subtype='PERCENTAGE'
+  )
+  use_thumbnail_size : BoolProperty(
+    name="Thumbnail Size",
+    description="Render at the size of the previews stored by the Asset Browser (256px).\nIgnore the resolution",
+    default=False
+  )
+  atlas_path : StringProperty(
+    name="Atlas Folder",
+    description="Pack the previews of a batch in sheets in this folder, with a JSON manifest (atlas.json).\nLet empty for no atlas",
+    default="",
+    maxlen=1024,
+    subtype='DIR_PATH'
+  )
+  atlas_size : IntProperty(
+    name="Sheet Size",
+    description="Width and height of the atlas sheets in pixels",
+    default=2048,
+    min=256,
+    max=16384,
+    subtype='PIXEL'
+  )
+  batch_collection : PointerProperty(
+    name="Batch Collection",
+    description="Collection rendered in one pass.\nLet empty to render the selected objects",
+    type=bpy.types.Collection
+  )
 
 
 classes = [
@@ -217,11 +430,25 @@ classes = [
   NXPREVIEW_PT_Background,
   NXPREVIEW_PT_Lighting,
   NXPREVIEW_PT_Camera,
+  NXPREVIEW_PT_Render,
   NXPREVIEW_PT_Output,
+  NXPREVIEW_PT_Stats,
   NXPREVIEW_PT_SaveAsset,
   OBJECT_OT_NXPreview,
+  OBJECT_OT_NXPreviewBatch,
+  OBJECT_OT_NXPreviewQueue,
+  OBJECT_OT_NXQueuePause,
+  OBJECT_OT_NXQueueCancel,
+  OBJECT_OT_NXStageClear,
+  OBJECT_OT_NXPurgeOrphans,
+  OBJECT_OT_NXResourcesReload,
+  OBJECT_OT_NXRelight,
+  OBJECT_OT_NXLivePreview,
+  OBJECT_OT_NXCacheClean,
   ASSET_OT_NXAssetToggle,
   ASSET_OT_NXAssetSave,
+  ASSET_OT_NXAssetExport,
+  ASSET_OT_NXLibrarySync,
   ASSET_OT_NXLibraryAdd,
   ASSET_OT_NXLibraryRemove,
 ]
@@ -231,9 +458,20 @@ def register():
     bpy.utils.register_class(cls)
 
   bpy.types.Scene.NXPreview= PointerProperty(type=MXPreviewProperties)
+
+  register_handlers()
+  nxstats.register_handlers()
+  nxbase_op.register_handlers()
     
 
 def unregister():
+  live_preview.stop()
+  library_writer.flush()
+  unregister_handlers()
+  nxstats.unregister_handlers()
+  nxbase_op.unregister_handlers()
+  nxbase_op.remove_stage()
+
   for cls in classes:
     bpy.utils.unregister_class(cls)
 
@@ -1,8 +1,13 @@
 import os
 import bpy
-from bpy.types import Operator
+from bpy.types import Operator, PropertyGroup
+from . nxpixels import copy_preview
+from . nxdata import data_registry
+from . nxwriter import library_writer
+from . nxsync import LibraryManifest, data_hash, preview_hash
 from bpy.props import (StringProperty, 
                        BoolProperty, 
+                       CollectionProperty,
                        IntProperty,
                        FloatProperty,
                        FloatVectorProperty)
@@ -36,37 +41,46 @@ class NXBaseAsset:
     default=False
   )
 
-  def purge_orphan_data(self):
-    print("====PURGE_ORPHAN_DATA====")
-
-    meshes = [mesh for mesh in bpy.data.meshes if mesh.users == 0 and mesh.name != "Backdrop"]
-    list(map(lambda mesh: bpy.data.meshes.remove(mesh, do_unlink=True), meshes))
-    
-    lights = [light for light in bpy.data.lights if light.users == 0 and 
-              light.name not in ["Area_1","Area_2","Area_3"]]
-    list(map(lambda light: bpy.data.lights.remove(light, do_unlink=True), lights))
-
-    cams = [cam for cam in bpy.data.objects if cam.type == "CAMERA" and cam.users == 0]
-    list(map(lambda cam: bpy.data.objects.remove(cam, do_unlink=True), cams))
-
-    cams = [cam for cam in bpy.data.cameras if cam.users == 0 and cam.name != "CamPreview"]
-    list(map(lambda cam: bpy.data.cameras.remove(cam, do_unlink=True), cams))
-    
-    ngs = [ng for ng in bpy.data.node_groups if ng.users == 0 and ng.name != "GNXBackdrop"]
-    list(map(lambda ng: bpy.data.node_groups.remove(ng, do_unlink=True), ngs))
-
-    worlds = [world for world in bpy.data.worlds if world.users == 0 and world.name != "WorldPreview"]
-    list(map(lambda world: bpy.data.worlds.remove(world, do_unlink=True), worlds))
-
-    imgs = [img for img in bpy.data.images if img.users == 0]
-    list(map(lambda img: bpy.data.images.remove(img, do_unlink=True), imgs))
-  
   def create_scene_and_switch_to(self, context, scene_name, switch_to=True):
     '''Create scene scene_name in not exist and switch to it'''
     if scene_name not in bpy.data.scenes:
       bpy.data.scenes.new(scene_name)    
-    if switch_to:
+    if switch_to and context.window is not None:
       context.window.scene = bpy.data.scenes[scene_name]
+
+  def get_library_path(self):
+    '''Folder of the selected library, None if it doesn't exist'''
+    libraries = bpy.context.preferences.filepaths.asset_libraries
+    if (self.library_id >= 0 and 
+        self.library_id < len(libraries) and
+        len(libraries[self.library_id].name) > 0 and
+        os.path.isdir(libraries[self.library_id].path)
+    ):
+      return libraries[self.library_id].path
+    return None
+
+
+def local_assets():
+  '''Objects of the file marked as asset'''
+  return [obj for obj in bpy.data.objects if obj.asset_data is not None and obj.library is None]
+
+
+def export_groups(objs, layout, file_name="assets"):
+  '''Objects by name of the .blend file written in the library'''
+  groups = {}
+  for obj in objs:
+    if layout == "SINGLE":
+      name = file_name
+    elif layout == "CATALOG":
+      name = obj.asset_data.catalog_simple_name or "Unassigned"
+    elif layout == "COLLECTION":
+      name = obj.users_collection[0].name if len(obj.users_collection) > 0 else "Unassigned"
+    else:
+      # the name of the object, as the single asset save
+      groups[obj.name] = [obj]
+      continue
+    groups.setdefault(bpy.path.clean_name(name), []).append(obj)
+  return groups
                  
 
 class ASSET_OT_NXAssetToggle(Operator):
@@ -101,7 +115,7 @@ class ASSET_OT_NXAssetSave(Operator, NXBaseAsset):
 
   def execute(self, context):
 
-    print("START SAVE ASSET", context.object.name)
+    print("START SAVE ASSET", self.original_object)
     if self.save_asset:
       obj = bpy.data.objects[self.original_object]
       libraries = bpy.context.preferences.filepaths.asset_libraries
@@ -117,39 +131,52 @@ class ASSET_OT_NXAssetSave(Operator, NXBaseAsset):
 
         bpy.context.scene.name = f"{self.original_scene}_"
         self.create_scene_and_switch_to(bpy.context, self.scene_asset, True)
+        asset_scene = bpy.data.scenes[self.scene_asset]
 
         o = obj
         if self.apply_modifiers:
           co = obj.copy()
-          co.data = obj.data.copy()
-          co.data.name = obj.data.name
           co.name = obj.name
-          bpy.context.collection.objects.link(co)
-          co.select_set(True)
-          bpy.context.view_layer.objects.active = co
-          bpy.ops.object.convert(target="MESH")
+          asset_scene.collection.objects.link(co)
+          # apply modifiers from the evaluated copy, no operator needed
+          view_layer = asset_scene.view_layers[0]
+          view_layer.update()
+          mesh = bpy.data.meshes.new_from_object(co.evaluated_get(view_layer.depsgraph))
+          mesh.name = obj.data.name
+          co.modifiers.clear()
+          co.data = mesh
           o = co
           o.asset_mark()          
           if self.assign_preview:
-            bpy.ops.ed.lib_id_load_custom_preview(
-              {"id":o}, 
-              filepath=self.filepath
-            )
+            # without preview file, the preview is copied from the original object
+            if os.path.isfile(self.filepath):
+              bpy.ops.ed.lib_id_load_custom_preview(
+                {"id":o}, 
+                filepath=self.filepath
+              )
+            else:
+              copy_preview(obj, o)
           else:
             pass
             # print('GENERATE_PREVIEW', o.name)
             # o.asset_generate_preview()
         else:
-          bpy.context.collection.objects.link(o)
-        data = {bpy.data.scenes[bpy.context.scene.name]}
-        bpy.data.libraries.write(path_, data)
-        bpy.data.scenes.remove(bpy.data.scenes[self.scene_asset])
-        bpy.context.scene.name = self.original_scene
+          asset_scene.collection.objects.link(o)
+        data = {asset_scene}
+        # written locally, copied to the library in the background
+        local_path = library_writer.local_path()
+        bpy.data.libraries.write(local_path, data)
+        library_writer.submit(local_path, path_)
+        if self.apply_modifiers:
+          # tracked after the write, the tag is not saved in the library
+          data_registry.track(o.data)
+        bpy.data.scenes.remove(asset_scene)
+        bpy.data.scenes[f"{self.original_scene}_"].name = self.original_scene
         if self.apply_modifiers:
           obj.data.name = o.data.name
           obj.name = o.name
           bpy.data.objects.remove(o, do_unlink=True)
-        self.purge_orphan_data()
+        data_registry.free()
         
         if bpy.data.is_saved:
           bpy.ops.file.make_paths_relative()
@@ -162,6 +189,197 @@ class ASSET_OT_NXAssetSave(Operator, NXBaseAsset):
     return {'FINISHED'}
 
 
+class ASSET_OT_NXAssetExport(Operator, NXBaseAsset):
+  bl_idname = "asset.nx_asset_export"
+  bl_label = "Export Assets"
+  bl_description = "Save the selected assets in the library, several assets by file"
+  bl_options = {"INTERNAL"}
+
+  objects : CollectionProperty(
+    type=PropertyGroup
+  )
+  layout : StringProperty(
+    default="ASSET"
+  )
+  file_name : StringProperty(
+    default="assets"
+  )
+
+  def get_objects(self, context):
+    '''Assets to export: objects list, else selection'''
+    if len(self.objects) > 0:
+      objs = [bpy.data.objects.get(item.name) for item in self.objects]
+    else:
+      objs = context.selected_objects
+    return [obj for obj in objs if obj is not None and obj.asset_data is not None]
+
+  def asset_copy(self, obj, asset_scene):
+    '''Copy of the object with its modifiers applied, named as the object'''
+    name = obj.name
+    obj.name = f"{name}_"
+    co = obj.copy()
+    mesh = None
+    try:
+      co.name = name
+      asset_scene.collection.objects.link(co)
+      view_layer = asset_scene.view_layers[0]
+      view_layer.update()
+      mesh = bpy.data.meshes.new_from_object(co.evaluated_get(view_layer.depsgraph))
+      mesh.name = obj.data.name
+      co.modifiers.clear()
+      co.data = mesh
+      co.asset_mark()
+      if self.assign_preview:
+        copy_preview(obj, co)
+    except Exception:
+      # the object keeps its name, the copy is not written
+      bpy.data.objects.remove(co, do_unlink=True)
+      if mesh is not None:
+        bpy.data.meshes.remove(mesh)
+      obj.name = name
+      raise
+    return co
+
+  def write_file(self, path_, objs):
+    '''Write the objects in one local file copied to path_ in the background,
+    return the number of assets written'''
+    asset_scene = bpy.data.scenes.new(self.scene_asset)
+    local_path = library_writer.local_path()
+    copies = []
+    try:
+      for obj in objs:
+        # only the meshes have their modifiers applied
+        if self.apply_modifiers and obj.type == 'MESH':
+          copies.append((obj, self.asset_copy(obj, asset_scene)))
+        else:
+          asset_scene.collection.objects.link(obj)
+      # only the paths of the written data are made absolute, not the whole file
+      bpy.data.libraries.write(local_path, {asset_scene}, path_remap='ABSOLUTE')
+    except Exception:
+      os.remove(local_path)
+      raise
+    finally:
+      bpy.data.scenes.remove(asset_scene)
+      for obj, co in copies:
+        name = co.name
+        # tracked after the write, the tag is not saved in the library
+        data_registry.track(co.data)
+        bpy.data.objects.remove(co, do_unlink=True)
+        obj.name = name
+    library_writer.submit(local_path, path_)
+    return len(objs)
+
+  def execute(self, context):
+    library_path = self.get_library_path()
+    if library_path is None:
+      self.report({'WARNING'}, "Library not found")
+      return {'CANCELLED'}
+
+    objs = self.get_objects(context)
+    if len(objs) == 0:
+      self.report({'WARNING'}, "No asset to export")
+      return {'CANCELLED'}
+
+    # renamed once, the scene of the library files is named Scene
+    original_scene = context.scene.name
+    context.scene.name = f"{original_scene}_"
+
+    written = 0
+    failed = []
+    groups = export_groups(objs, self.layout, self.file_name)
+    if self.layout != "ASSET":
+      # a file is written again with all its assets, not only the exported ones
+      groups = {file_name: group for file_name, group in 
+                export_groups(local_assets(), self.layout, self.file_name).items()
+                if file_name in groups}
+    for file_name, group in groups.items():
+      path_ = os.path.join(library_path, f"{file_name}.blend")
+      try:
+        written += self.write_file(path_, group)
+        print(f"NX_Preview: {len(group)} assets saved in {path_}")
+      except Exception as e:
+        failed.append(file_name)
+        print(f"NX_Preview: {path_} not saved: {e}")
+
+    bpy.data.scenes[f"{original_scene}_"].name = original_scene
+    data_registry.free()
+
+    if len(failed) > 0:
+      self.report({'WARNING'}, f"{written} assets saved, files not saved: {', '.join(failed)}")
+    else:
+      self.report({'INFO'}, f"{written} assets saved in {len(groups)} files, {library_writer.pending} files copying")
+    return {'FINISHED'}
+
+
+class ASSET_OT_NXLibrarySync(Operator, NXBaseAsset):
+  bl_idname = "asset.nx_library_sync"
+  bl_label = "Sync Library"
+  bl_description = "Save the new or changed assets of the file in the library"
+  bl_options = {"INTERNAL"}
+
+  layout : StringProperty(
+    default="ASSET"
+  )
+  file_name : StringProperty(
+    default="assets"
+  )
+  remove_stale : BoolProperty(
+    default=False
+  )
+
+  def execute(self, context):
+    library_path = self.get_library_path()
+    if library_path is None:
+      self.report({'WARNING'}, "Library not found")
+      return {'CANCELLED'}
+
+    manifest = LibraryManifest(library_path)
+    depsgraph = context.evaluated_depsgraph_get()
+    hashes = {}
+    for obj in local_assets():
+      hashes[obj.name] = {
+        "data": data_hash(obj, obj.evaluated_get(depsgraph), self.apply_modifiers),
+        "preview": preview_hash(obj)
+      }
+
+    groups = {file_name: [obj.name for obj in group] for file_name, group in
+              export_groups(local_assets(), self.layout, self.file_name).items()}
+    changed = [file_name for file_name, names in groups.items()
+               if manifest.is_changed(file_name, names, hashes)]
+
+    saved = 0
+    if len(changed) > 0:
+      mtimes = {file_name: manifest.file_mtime(file_name) for file_name in changed}
+      bpy.ops.asset.nx_asset_export(
+                                    objects=[{"name": name} for file_name in changed for name in groups[file_name]],
+                                    layout=self.layout,
+                                    file_name=self.file_name,
+                                    assign_preview=self.assign_preview,
+                                    library_id=self.library_id,
+                                    apply_modifiers=self.apply_modifiers
+                                  )
+      # the manifest needs the date of the files in the library,
+      # a file with the same date was not written
+      library_writer.flush()
+      for file_name in changed:
+        if manifest.file_mtime(file_name) not in (0.0, mtimes[file_name]):
+          manifest.update(file_name, groups[file_name], hashes)
+          saved += 1
+
+    stale = manifest.stale_files(groups)
+    if self.remove_stale:
+      for file_name in stale:
+        manifest.remove_file(file_name)
+        print(f"NX_Preview: stale file {file_name}.blend removed")
+    manifest.save()
+
+    msg = f"{saved}/{len(groups)} library files saved"
+    if len(stale) > 0:
+      msg += f", {len(stale)} stale files {'removed' if self.remove_stale else 'kept'}"
+    self.report({'INFO'} if saved == len(changed) else {'WARNING'}, msg)
+    return {'FINISHED'}
+
+
 class ASSET_OT_NXLibraryAdd(Operator):
   bl_idname = "asset.nx_library_add"
   bl_label = "Add Lirary"
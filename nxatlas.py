@@ -0,0 +1,84 @@
+'''Previews packed in large sheets, for the web catalogs and the review tools.
+
+The previews are added one by one while they are rendered, only the sheet
+being filled is kept in memory (8 bits). A full sheet is written and a new one
+started. close() writes the last sheet and a JSON manifest with the rectangle
+of each asset: pixels from the top left corner of its sheet and UV coordinates.
+'''
+import json
+import os
+import numpy as np
+from . nxpixels import downscale, save_pixels
+
+MANIFEST_VERSION = 1
+
+
+class AtlasBuilder:
+  def __init__(self, directory, name="atlas", sheet_size=2048, tile_size=256):
+    self.directory = directory
+    self.name = name
+    self.tile_size = tile_size
+    self.columns = max(1, sheet_size // tile_size)
+    self.sheet_size = self.columns * tile_size
+    self.sheet = None
+    self.count = 0
+    self.sheets = []
+    self.assets = {}
+
+  @property
+  def manifest_path(self):
+    return os.path.join(self.directory, f"{self.name}.json")
+
+  def sheet_name(self, index):
+    return f"{self.name}_{index:03d}.png"
+
+  def add(self, asset_name, pixels):
+    '''Put the display RGBA pixels (height, width, 4) of the asset in the next cell'''
+    if asset_name in self.assets:
+      return
+    if self.sheet is None:
+      self.sheet = np.zeros((self.sheet_size, self.sheet_size, 4), dtype=np.uint8)
+      self.count = 0
+
+    pixels = downscale(pixels, self.tile_size)
+    height, width = pixels.shape[:2]
+    # centered in its cell, from the top left corner
+    x = (self.count % self.columns) * self.tile_size + (self.tile_size - width) // 2
+    y = (self.count // self.columns) * self.tile_size + (self.tile_size - height) // 2
+    # the images are stored from the bottom row
+    self.sheet[y:y + height, x:x + width] = np.round(np.clip(pixels[::-1], 0, 1) * 255)
+
+    self.assets[asset_name] = {
+      "sheet": len(self.sheets),
+      "rect": [x, y, width, height],
+      "uv": [round(v / self.sheet_size, 6) for v in (x, y, x + width, y + height)]
+    }
+    self.count += 1
+    if self.count == self.columns * self.columns:
+      self.write_sheet()
+
+  def write_sheet(self):
+    if self.sheet is None:
+      return
+    os.makedirs(self.directory, exist_ok=True)
+    name = self.sheet_name(len(self.sheets))
+    save_pixels(self.sheet[::-1].astype(np.float32) / 255, os.path.join(self.directory, name))
+    self.sheets.append(name)
+    self.sheet = None
+    print(f"NX_Preview: atlas sheet {name} written")
+
+  def close(self):
+    '''Write the last sheet and the manifest, return the manifest path'''
+    self.write_sheet()
+    manifest = {
+      "version": MANIFEST_VERSION,
+      "sheet_size": self.sheet_size,
+      "tile_size": self.tile_size,
+      "sheets": self.sheets,
+      "assets": self.assets
+    }
+    tmp_path = f"{self.manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+      json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, self.manifest_path)
+    return self.manifest_path
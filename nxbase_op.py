@@ -2,8 +2,19 @@ import numpy as np
 import mathutils
 from math import radians
 import os
-import tempfile
 import bpy
+from bpy.app.handlers import persistent
+from . nxcache import asset_key, managed_cache_dir, PreviewCache
+from . nxpixels import (read_viewer_pixels, downscale, linear_to_srgb, set_preview_pixels,
+                        new_sheet, paste_tile, save_pixels, alpha_over, read_image_file)
+from . nxdata import data_registry, tag_data, free_tagged
+from . nxframing import mesh_coords, object_coords, extents, normalize_scale, fit_camera, rotate_z
+from . nxstats import preview_stats
+from . nxqueue import render_queue
+from . nxresources import get_backdrop_group, get_world_image, release_resources
+from . nxwriter import library_writer
+from . nxrelight import (LIGHT_GROUPS, PREFIX, PASSES_KEY, lightgroups_supported, 
+                         get_strengths, save_passes)
 from bpy.props import (StringProperty, 
                        BoolProperty, 
                        IntProperty,
@@ -19,6 +30,75 @@ class NXBase:
     "ext": "png" 
   }
 
+  # size of the previews stored by Blender for the Asset Browser
+  thumbnail_size=256
+
+  # base colors of the backdrop styles
+  backdrop_colors={
+    "LIGHT": (0.8, 0.8, 0.8),
+    "NEUTRAL": (0.25, 0.25, 0.25),
+    "DARK": (0.01, 0.01, 0.01)
+  }
+  backdrop_aov="nx_backdrop"
+
+  # linear colors of the background variants, None is transparent
+  background_presets={
+    "NONE": None,
+    "NEUTRAL": (0.214, 0.214, 0.214),
+    "LIGHT": (0.723, 0.723, 0.723),
+    "DARK": (0.019, 0.019, 0.019)
+  }
+
+  # EEVEE is the default engine of a new scene, the Cycles profiles render on CPU
+  render_profiles={
+    "EEVEE": {
+      "engine": "BLENDER_EEVEE"
+    },
+    "DRAFT": {
+      "engine": "CYCLES",
+      "samples": 16,
+      "adaptive_threshold": 0.1,
+      "denoise": True,
+      "bounces": 2
+    },
+    "STANDARD": {
+      "engine": "CYCLES",
+      "samples": 64,
+      "adaptive_threshold": 0.05,
+      "denoise": True,
+      "bounces": 4
+    },
+    "FINAL": {
+      "engine": "CYCLES",
+      "samples": 256,
+      "adaptive_threshold": 0.01,
+      "denoise": True,
+      "bounces": 8
+    }
+  }
+
+  # settings changing the rendered image, part of the cache key
+  render_keys=(
+    "use_backdrop",
+    "backdrop_style",
+    "backdrop_variants",
+    "use_relight",
+    "use_background",
+    "background_color",
+    "background_compositing",
+    "world_strength",
+    "light_top_strength",
+    "light_left_strength",
+    "light_right_strength",
+    "camera_focal",
+    "camera_align_h",
+    "camera_align_v",
+    "render_profile",
+    "resolution",
+    "resolution_percentage",
+    "use_thumbnail_size"
+  )
+
   path: StringProperty(
     name="",
     description="Path to Preview Output",
@@ -29,6 +109,9 @@ class NXBase:
   preview_filepath: StringProperty(
     default=""
   )
+  preview_key: StringProperty(
+    default=""
+  )
   original_scene : StringProperty(
     default=""
   )
@@ -45,7 +128,7 @@ class NXBase:
     default=False
   )
   backdrop_style : StringProperty(
-    default=""
+    default="NEUTRAL"
   )
   use_background : BoolProperty(
     default=False
@@ -99,35 +182,87 @@ class NXBase:
   apply_modifier : BoolProperty(
     default=False
   )
+  export_layout : StringProperty(
+    default="ASSET"
+  )
+  export_file_name : StringProperty(
+    default="assets"
+  )
+  sync_library : BoolProperty(
+    default=False
+  )
+  multi_view : StringProperty(
+    default="NONE"
+  )
+  background_compositing : StringProperty(
+    default="COMPOSITOR"
+  )
+  backdrop_variants : BoolProperty(
+    default=False
+  )
+  use_relight : BoolProperty(
+    default=False
+  )
+  background_variants : BoolProperty(
+    default=False
+  )
+  view_count : IntProperty(
+    default=8,
+    min=2,
+    max=64
+  )
+  use_cache : BoolProperty(
+    default=True
+  )
+  cache_max_size : IntProperty(
+    default=1024,
+    min=0
+  )
+  render_profile : StringProperty(
+    default="EEVEE"
+  )
+  render_threads : IntProperty(
+    default=0,
+    min=0
+  )
+  resolution : IntProperty(
+    default=512,
+    min=16,
+    max=4096
+  )
+  resolution_percentage : IntProperty(
+    default=100,
+    min=1,
+    max=100
+  )
+  use_thumbnail_size : BoolProperty(
+    default=False
+  )
+  save_preview_file : BoolProperty(
+    default=True
+  )
+  stage_mode : StringProperty(
+    default="COPY"
+  )
+  stats_path : StringProperty(
+    default="",
+    subtype='FILE_PATH'
+  )
+  cache_max_days : IntProperty(
+    default=30,
+    min=0
+  )
 
   @classmethod
   def poll(cls, context):
-    return context.object
+    # the queue renders the stage, it can't be built again until it ends
+    return context.object and not render_queue.running
   
-  def purge_orphan_data(self):
-    print("====PURGE_ORPHAN_DATA====")
-
-    meshes = [mesh for mesh in bpy.data.meshes if mesh.users == 0 and mesh.name != "Backdrop"]
-    list(map(lambda mesh: bpy.data.meshes.remove(mesh, do_unlink=True), meshes))
-    
-    lights = [light for light in bpy.data.lights if light.users == 0 and 
-              light.name not in ["Area_1","Area_2","Area_3"]]
-    list(map(lambda light: bpy.data.lights.remove(light, do_unlink=True), lights))
-
-    cams = [cam for cam in bpy.data.objects if cam.type == "CAMERA" and cam.users == 0]
-    list(map(lambda cam: bpy.data.objects.remove(cam, do_unlink=True), cams))
-
-    cams = [cam for cam in bpy.data.cameras if cam.users == 0 and cam.name != "CamPreview"]
-    list(map(lambda cam: bpy.data.cameras.remove(cam, do_unlink=True), cams))
-    
-    ngs = [ng for ng in bpy.data.node_groups if ng.users == 0 and ng.name != "GNXBackdrop"]
-    list(map(lambda ng: bpy.data.node_groups.remove(ng, do_unlink=True), ngs))
-
-    worlds = [world for world in bpy.data.worlds if world.users == 0 and world.name != "WorldPreview"]
-    list(map(lambda world: bpy.data.worlds.remove(world, do_unlink=True), worlds))
-
-    imgs = [img for img in bpy.data.images if img.users == 0]
-    list(map(lambda img: bpy.data.images.remove(img, do_unlink=True), imgs))
+  def free_run_data(self):
+    '''Remove the datablocks created by the preview run and no longer used'''
+    removed = data_registry.free()
+    if removed > 0:
+      print(f"NX_Preview: {removed} datablocks removed")
   
   def purge_scene(self, scene_name):
     '''Remove all objects in the scene'''
@@ -135,49 +270,110 @@ class NXBase:
       bpy.data.objects.remove(o, do_unlink=True)
 
   def create_scene_and_switch_to(self, context, scene_name, switch_to=True):
-    '''Create scene scene_name in not exist and switch to it'''
+    '''Create scene scene_name in not exist and switch to it.
+    There is no window in background mode, the scene is only created'''
     if scene_name not in bpy.data.scenes:
-      bpy.data.scenes.new(scene_name)    
-    if switch_to:
+      tag_data(bpy.data.scenes.new(scene_name))
+    if switch_to and context.window is not None:
       context.window.scene = bpy.data.scenes[scene_name]
+
+  def get_stage(self):
+    return bpy.data.scenes[self.scene_preview]
+
+  def evaluated_depsgraph(self, scene):
+    '''Evaluated depsgraph of the scene, without the need of a window'''
+    view_layer = scene.view_layers[0]
+    view_layer.update()
+    return view_layer.depsgraph
   
-  def copy_object(self, context):
+  def copy_object(self, scene):
     obj = bpy.data.objects[self.original_object]
     copy = obj.copy()
-    copy.data = obj.data.copy()
     copy.name = "Preview"
-    context.collection.objects.link(copy)
-    context.view_layer.objects.active = copy
-    copy.select_set(True)
-    bpy.ops.object.convert(target="MESH")
+    scene.collection.objects.link(copy)
+    data_registry.track(copy)
+
+    if self.stage_mode == "LINK":
+      self.link_object(scene, copy)
+      return
+
+    # convert to mesh from the evaluated copy, no operator needed
+    depsgraph = self.evaluated_depsgraph(scene)
+    mesh = data_registry.track(bpy.data.meshes.new_from_object(copy.evaluated_get(depsgraph)))
+    copy.modifiers.clear()
+    copy.data = mesh
     copy.location = (0,0,0)
     copy.rotation_euler = (0,0,0)
     copy.hide_render = False
 
-    dims = [d for d in copy.dimensions]
-    maxi = max(dims)
-    index = dims.index(maxi)
-    copy.dimensions[index] = 2
-    copy.scale[0] = copy.scale[index]
-    copy.scale[1] = copy.scale[index]
-    copy.scale[2] = copy.scale[index]
+    scale = normalize_scale(mesh_coords(mesh), copy.scale)
+    if scale is not None:
+      copy.scale = (scale,) * 3
 
-  def add_cam(self, context):
-    target = context.object
-    
-    if 'CamPreview' not in bpy.data.cameras:
-        camData = bpy.data.cameras.new("CamPreview")
-    else:
-        camData = bpy.data.cameras['CamPreview']            
-    cam = bpy.data.objects.new("CamPreview", camData)
-    context.scene.collection.objects.link(cam)
-    
-    context.scene.camera = cam
+  def get_preview_root(self, scene):
+    '''Empty parent of the linked Preview object, holds the normalizing scale'''
+    root = scene.objects.get("PreviewRoot")
+    if root is None:
+      root = tag_data(bpy.data.objects.new("PreviewRoot", None))
+      scene.collection.objects.link(root)
+    return root
 
-    context.scene.render.resolution_x = 512
-    context.scene.render.resolution_y = 512
-    
-    target_loc = mathutils.Vector(target.location)
+  def link_object(self, scene, copy):
+    '''The copy shares the mesh and the modifiers of the original object,
+    they are evaluated once by the stage and the mesh is not duplicated'''
+    root = self.get_preview_root(scene)
+    root.location = (0,0,0)
+    root.rotation_euler = (0,0,0)
+    root.scale = (1,1,1)
+    copy.parent = root
+    copy.matrix_parent_inverse.identity()
+    copy.location = (0,0,0)
+    copy.rotation_euler = (0,0,0)
+    copy.hide_render = False
+
+    depsgraph = self.evaluated_depsgraph(scene)
+    maxi = max(extents(object_coords(copy.evaluated_get(depsgraph), use_vertices=False)))
+    if maxi > 0:
+      root.scale = (2 / maxi,) * 3
+
+  def stage_setting_changed(self, scene, key, value):
+    '''Remember the value used by the stage for key, return True if it has changed'''
+    value = repr(value)
+    if scene.get(f"nx_{key}") == value:
+      return False
+    scene[f"nx_{key}"] = value
+    return True
+
+  def add_cam(self, scene):
+    if scene.camera is None or scene.camera.name not in scene.objects:
+      if 'CamPreview' not in bpy.data.cameras:
+          camData = tag_data(bpy.data.cameras.new("CamPreview"))
+      else:
+          camData = bpy.data.cameras['CamPreview']            
+      cam = tag_data(bpy.data.objects.new("CamPreview", camData))
+      scene.collection.objects.link(cam)
+      
+      scene.camera = cam
+
+    if self.stage_setting_changed(scene, "resolution", self.render_size()):
+      scene.render.resolution_x = self.render_size()
+      scene.render.resolution_y = self.render_size()
+      scene.render.resolution_percentage = 100
+
+  def render_size(self):
+    '''Size in pixels of the rendered preview'''
+    if self.use_thumbnail_size:
+      return self.thumbnail_size
+    return max(1, self.resolution * self.resolution_percentage // 100)
+
+  def preview_coords(self, scene):
+    '''World coordinates of the vertices of the evaluated Preview object'''
+    depsgraph = self.evaluated_depsgraph(scene)
+    return object_coords(scene.objects['Preview'].evaluated_get(depsgraph))
+
+  def frame_cam(self, scene, coords):
+    '''Point the camera to the Preview object and frame it'''
+    cam = scene.camera
 
     if self.camera_align_h == "RIGHT":
       x = 2.5
@@ -193,51 +389,115 @@ class NXBase:
     else:
       z = -5
 
-    cam.location = target_loc + mathutils.Vector((x,-6,z))
-    context.view_layer.update()
-    loc_cam = cam.matrix_world.to_translation()
-    direction = target.location - loc_cam
+    direction = mathutils.Vector((-x,6,-z))
     rot_quat = direction.to_track_quat('-Z', 'Y')
     cam.rotation_euler = rot_quat.to_euler()
-    cam.data.lens = self.camera_focal + 5    
-    bpy.ops.view3d.camera_to_view_selected()    
+
+    # same as view3d.camera_to_view_selected but usable in background mode,
+    # framed with a longer focal to keep a margin around the object
+    cam.location = fit_camera(coords, rot_quat.to_matrix(), self.camera_focal + 5, 
+                              cam.data.sensor_width)
     cam.data.lens = self.camera_focal
       
-  def add_light(self, context, name, 
+  def add_light(self, scene, name, 
                 type="AREA", loc=(0,0,0), rot=(0,0,0), size=0.25, energy=10, energy_max=100):
-    if name not in bpy.data.lights:
-        lgt = bpy.data.lights.new(name=name, type=type)
-    else:
-        lgt = bpy.data.lights[name]
-    lgt.use_contact_shadow = True
-    light = bpy.data.objects.new(name, lgt)
-    context.scene.collection.objects.link(light)
-        
-    light.data.energy = np.interp(energy, [0,1], [0,energy_max])
-    light.data.size = size
-    light.location = loc
-    light.rotation_euler = list(map(radians, rot))
+    changed = self.stage_setting_changed(scene, name, energy)
+    light = scene.objects.get(name)
+    if light is None:
+      if name not in bpy.data.lights:
+          lgt = tag_data(bpy.data.lights.new(name=name, type=type))
+      else:
+          lgt = bpy.data.lights[name]
+      lgt.use_contact_shadow = True
+      light = tag_data(bpy.data.objects.new(name, lgt))
+      scene.collection.objects.link(light)
+
+      light.data.size = size
+      light.location = loc
+      light.rotation_euler = list(map(radians, rot))
+      changed = True
+
+    if changed:
+      light.data.energy = np.interp(energy, [0,1], [0,energy_max])
   
-  def add_world(self, context):
+  def set_render_profile(self, scene):
+    '''Set engine, samples, denoiser, light bounces and threads of the profile'''
+    if self.stage_setting_changed(scene, "render_threads", self.render_threads):
+      scene.render.threads_mode = 'FIXED' if self.render_threads > 0 else 'AUTO'
+      if self.render_threads > 0:
+        scene.render.threads = self.render_threads
+
+    if not self.stage_setting_changed(scene, "render_profile", self.render_profile):
+      return
+    profile = self.render_profiles.get(self.render_profile, self.render_profiles["EEVEE"])
+    scene.render.engine = profile["engine"]
+    if profile["engine"] != "CYCLES":
+      return
+
+    cycles = scene.cycles
+    cycles.samples = profile["samples"]
+    cycles.use_adaptive_sampling = True
+    cycles.adaptive_threshold = profile["adaptive_threshold"]
+    cycles.use_denoising = profile["denoise"]
+    cycles.denoiser = 'OPENIMAGEDENOISE'
+    cycles.max_bounces = profile["bounces"]
+    cycles.diffuse_bounces = min(profile["bounces"], 4)
+    cycles.glossy_bounces = min(profile["bounces"], 4)
+    cycles.transmission_bounces = profile["bounces"]
+    cycles.transparent_max_bounces = profile["bounces"]
+    cycles.volume_bounces = 0
+
+  def numpy_pixels(self, scene):
+    '''The render is read from the viewer and converted with NumPy (linear_to_srgb)'''
+    return self.needs_viewer() or self.multi_view == "SHEET" or self.relight_active(scene)
+
+  def set_color_management(self, scene):
+    '''linear_to_srgb is the Standard view transform. When the pixels are
+    converted with NumPy, the stage uses it so the files written by the
+    compositor have the same tones, at the cost of the Filmic look of a new scene.
+    Otherwise the view settings of the scene are kept, or restored'''
+    view_settings = scene.view_settings
+    saved = scene.get("nx_view_settings")
+    if self.numpy_pixels(scene):
+      if saved is None:
+        scene["nx_view_settings"] = {name: getattr(view_settings, name) for name in
+                                     ("view_transform", "look", "exposure", "gamma", "use_curve_mapping")}
+        view_settings.view_transform = 'Standard'
+        view_settings.look = 'None'
+        view_settings.exposure = 0.0
+        view_settings.gamma = 1.0
+        view_settings.use_curve_mapping = False
+    elif saved is not None:
+      for name, value in saved.items():
+        setattr(view_settings, name, value)
+      del scene["nx_view_settings"]
+
+  def add_world(self, scene):
     if 'WorldPreview' not in bpy.data.worlds:
-        bpy.data.worlds.new('WorldPreview')
+        tag_data(bpy.data.worlds.new('WorldPreview'))
     
     bpy.data.worlds['WorldPreview'].use_nodes = True
-    context.scene.world = bpy.data.worlds['WorldPreview']
+    scene.world = bpy.data.worlds['WorldPreview']
     
-    node_tree = context.scene.world.node_tree
+    node_tree = scene.world.node_tree
     tree_nodes = node_tree.nodes
 
+    changed = self.stage_setting_changed(scene, "world_strength", self.world_strength)
+    if all(n in tree_nodes for n in ("Background", "Environment Texture", "World Output")):
+      if changed:
+        tree_nodes["Background"].inputs[1].default_value = self.world_strength
+      image = get_world_image()
+      if tree_nodes["Environment Texture"].image != image:
+        tree_nodes["Environment Texture"].image = image
+      return
+
     tree_nodes.clear()
 
     node_background = tree_nodes.new(type='ShaderNodeBackground')
     node_background.inputs[1].default_value = self.world_strength
 
     node_environment = tree_nodes.new('ShaderNodeTexEnvironment')
-    if "city.exr" not in bpy.data.images:
-      node_environment.image = bpy.data.images.load(context.preferences.studio_lights['city.exr'].path)
-    else:
-      node_environment.image = bpy.data.images['city.exr']
+    node_environment.image = get_world_image()
     node_environment.location = -300,0
 
     node_output = tree_nodes.new(type='ShaderNodeOutputWorld')   
@@ -247,60 +507,316 @@ class NXBase:
     links.new(node_environment.outputs["Color"], node_background.inputs["Color"])
     links.new(node_background.outputs["Background"], node_output.inputs["Surface"])
 
-  def add_material_backdrop(self, context):
-    obj = bpy.data.objects["Backdrop"]
-
+  def add_material_backdrop(self, scene):
+    # with the variants, the backdrop is white and recolored after the render
+    style = "WHITE" if self.backdrop_variants else self.backdrop_style
+    changed = self.stage_setting_changed(scene, "backdrop_style", style)
     if "MatBackdrop" not in bpy.data.materials:
-      mat = bpy.data.materials.new(name="MatBackdrop")
+      mat = tag_data(bpy.data.materials.new(name="MatBackdrop"))
+    elif not changed:
+      return
     else:
       mat = bpy.data.materials["MatBackdrop"]
-    
+
     mat.use_nodes = True
-    if self.backdrop_style == "LIGHT":
-      color = (0.8,0.8,0.8,1.0)
-    elif self.backdrop_style == "DARK":
-      color = (0.01,0.01,0.01,1.0)
+    nodes = mat.node_tree.nodes
+    color = (1.0, 1.0, 1.0) if style == "WHITE" else self.backdrop_colors[self.get_backdrop_style()]
+    nodes["Principled BSDF"].inputs[0].default_value = (*color, 1.0)
+
+    # mask of the backdrop in the AOV pass
+    if "NX_AOV" not in nodes:
+      aov = nodes.new(type="ShaderNodeOutputAOV")
+      aov.name = "NX_AOV"
+      aov.location = (300, 300)
+      aov.inputs["Value"].default_value = 1.0
+    nodes["NX_AOV"].aov_name = self.backdrop_aov
+
+  def get_backdrop_style(self):
+    '''Style of the backdrop, NEUTRAL if the setting is unknown'''
+    return self.backdrop_style if self.backdrop_style in self.backdrop_colors else "NEUTRAL"
+
+  def backdrop_variants_active(self):
+    return self.use_backdrop and self.backdrop_variants
+
+  def add_backdrop_variants(self, scene):
+    '''Compositor nodes recoloring the white backdrop in each style.
+    The backdrop is diffuse, its light is scaled by the color of the style:
+    style = image - light * mask + light * mask * color'''
+    view_layer = scene.view_layers[0]
+    view_layer.use_pass_diffuse_direct = True
+    view_layer.use_pass_diffuse_indirect = True
+    if self.backdrop_aov not in view_layer.aovs:
+      aov = view_layer.aovs.add()
+      aov.name = self.backdrop_aov
+      aov.type = 'VALUE'
+
+    if not scene.use_nodes:
+      scene.use_nodes = True
+    node_tree = scene.node_tree
+    nodes = node_tree.nodes
+    if 'NX_BackdropVariants' in nodes:
+      nodes['NX_BackdropVariants'].mute = False
+      self.link_indirect_light(scene)
+      return
+
+    render_layers = nodes['Render Layers']
+    def mix(name, blend_type, location, input_1, input_2):
+      node = nodes.new(type="CompositorNodeMixRGB")
+      node.name = name
+      node.blend_type = blend_type
+      node.location = location
+      node_tree.links.new(node.inputs[1], input_1)
+      if input_2 is not None:
+        node_tree.links.new(node.inputs[2], input_2)
+      return node
+
+    light = mix('NX_Light', 'ADD', (200, -400), render_layers.outputs['DiffDir'], None)
+    self.link_indirect_light(scene)
+    backdrop_light = mix('NX_BackdropLight', 'MULTIPLY', (400, -400), light.outputs[0],
+                         render_layers.outputs[self.backdrop_aov])
+    base = mix('NX_BackdropBase', 'SUBTRACT', (600, -400), render_layers.outputs[0],
+               backdrop_light.outputs[0])
+
+    output = nodes.new(type="CompositorNodeOutputFile")
+    output.name = 'NX_BackdropVariants'
+    output.location = (1200, -400)
+    output.format.file_format = self.file_format["format"]
+    output.format.color_mode = 'RGBA'
+    output.file_slots.clear()
+    for i, (style, color) in enumerate(self.backdrop_colors.items()):
+      colored = mix(f'NX_Color_{style}', 'MULTIPLY', (800, -400 - i * 200), 
+                    backdrop_light.outputs[0], None)
+      colored.inputs[2].default_value = (*color, 1.0)
+      variant = mix(f'NX_Backdrop_{style}', 'ADD', (1000, -400 - i * 200), 
+                    base.outputs[0], colored.outputs[0])
+      output.file_slots.new(style)
+      node_tree.links.new(output.inputs[i], variant.outputs[0])
+
+  def link_indirect_light(self, scene):
+    '''Add the indirect diffuse pass to the backdrop light with Cycles.
+    EEVEE has only the direct pass, it has all the light.
+    The engine can change between two renders of the stage'''
+    node_tree = scene.node_tree
+    light_input = node_tree.nodes['NX_Light'].inputs[2]
+    indirect = None
+    if scene.render.engine == 'CYCLES':
+      indirect = node_tree.nodes['Render Layers'].outputs.get('DiffInd')
+
+    linked = light_input.links[0].from_socket if len(light_input.links) > 0 else None
+    if linked != indirect:
+      for link in list(light_input.links):
+        node_tree.links.remove(link)
+      if indirect is not None:
+        node_tree.links.new(light_input, indirect)
+    if indirect is None and tuple(light_input.default_value) != (0, 0, 0, 1):
+      light_input.default_value = (0, 0, 0, 1)
+
+  def relight_active(self, scene):
+    '''Light groups are rendered by Cycles since Blender 3.2'''
+    return (self.use_relight and scene.render.engine == 'CYCLES' and 
+            lightgroups_supported(scene.view_layers[0]))
+
+  def get_passes_dir(self):
+    directory = os.path.join(managed_cache_dir(), "light_passes")
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+  def add_light_groups(self, scene):
+    '''Put each light and the world in a light group, the compositor writes
+    their passes and the alpha in EXR files'''
+    view_layer = scene.view_layers[0]
+    for group in LIGHT_GROUPS:
+      name = f"{PREFIX}{group}"
+      if name not in view_layer.lightgroups:
+        view_layer.lightgroups.add(name=name)
+      target = scene.world if group == "World" else scene.objects[group]
+      if target.lightgroup != name:
+        target.lightgroup = name
+
+    if not scene.use_nodes:
+      scene.use_nodes = True
+    node_tree = scene.node_tree
+    nodes = node_tree.nodes
+    if 'NX_LightPasses' in nodes:
+      return
+
+    render_layers = nodes['Render Layers']
+    output = nodes.new(type="CompositorNodeOutputFile")
+    output.name = 'NX_LightPasses'
+    output.location = (1200, -1200)
+    output.format.file_format = 'OPEN_EXR'
+    output.format.color_mode = 'RGBA'
+    output.file_slots.clear()
+    for i, group in enumerate(list(LIGHT_GROUPS) + ["Alpha"]):
+      output.file_slots.new(group)
+      source = 'Alpha' if group == "Alpha" else f"Combined_{PREFIX}{group}"
+      node_tree.links.new(output.inputs[i], render_layers.outputs[source])
+
+  def set_light_pass_output(self, scene):
+    if not self.relight_active(scene):
+      return
+    output = scene.node_tree.nodes['NX_LightPasses']
+    output.base_path = self.get_passes_dir()
+    for slot, group in zip(output.file_slots, list(LIGHT_GROUPS) + ["Alpha"]):
+      slot.path = f"{self.original_object}_{group}_"
+
+  def store_light_passes(self, scene, cache=None, key="", rendered=True):
+    '''Keep the light passes of the last render at the thumbnail size, for the
+    relight of the preview. The file is in the preview cache, for its eviction.
+    Return the path of the passes'''
+    if not self.relight_active(scene):
+      return ""
+    filepath = os.path.join(self.get_preview_dir(), f"{self.original_object}_lights.npz")
+    if cache is not None and self.use_cache and cache.lookup(f"{key}:lights", filepath):
+      bpy.data.objects[self.original_object][PASSES_KEY] = filepath
+      return filepath
+    if not rendered:
+      return ""
+    directory = self.get_passes_dir()
+
+    def read_pass(group):
+      filepath = os.path.join(directory, f"{self.original_object}_{group}_{scene.frame_current:04d}.exr")
+      pixels = downscale(read_image_file(filepath), self.thumbnail_size)
+      os.remove(filepath)
+      return pixels
+
+    with preview_stats.stage("light_passes"):
+      passes = {group: read_pass(group)[..., :3] for group in LIGHT_GROUPS}
+      alpha = read_pass("Alpha")[..., 0]
+      save_passes(filepath, passes, alpha, get_strengths(self))
+    if cache is not None:
+      cache.add(f"{key}:lights", filepath)
     else:
-      color = (0.25,0.25,0.25,1.0)
-    mat.node_tree.nodes["Principled BSDF"].inputs[0].default_value = color
+      # the preview without file has no cache, the passes are indexed alone
+      passes_cache = PreviewCache(self.get_preview_dir())
+      passes_cache.add(f"{key}:lights", filepath)
+      passes_cache.save()
+    bpy.data.objects[self.original_object][PASSES_KEY] = filepath
+    return filepath
+
+  def render_again(self, scene, outputs=()):
+    '''Render the staged object for the images of a preview found in the cache.
+    Only the file outputs of the compositor in outputs write their files,
+    the other ones would leave files no one reads'''
+    self.set_render_output(scene)
+    self.set_backdrop_variant_output(scene)
+    self.set_light_pass_output(scene)
+    nodes = scene.node_tree.nodes if scene.use_nodes else {}
+    muted = [nodes[name] for name in ('NX_BackdropVariants', 'NX_LightPasses')
+               if name in nodes and name not in outputs and not nodes[name].mute]
+    for node in muted:
+      node.mute = True
+    try:
+      with preview_stats.stage("render"):
+        bpy.ops.render.render(scene=scene.name)
+    finally:
+      for node in muted:
+        node.mute = False
+
+  def mute_file_outputs(self, scene, mute=True):
+    '''Mute the file outputs of the compositor, or restore them'''
+    if not scene.use_nodes:
+      return
+    nodes = scene.node_tree.nodes
+    for name, active in (('NX_BackdropVariants', self.backdrop_variants_active()),
+                         ('NX_LightPasses', self.relight_active(scene))):
+      if name in nodes and nodes[name].mute != (mute or not active):
+        nodes[name].mute = mute or not active
+
+  def image_source(self, scene):
+    '''Socket of the rendered image in the compositor, recolored in the
+    selected style with the backdrop variants'''
+    nodes = scene.node_tree.nodes
+    if self.backdrop_variants_active():
+      return nodes[f'NX_Backdrop_{self.get_backdrop_style()}'].outputs[0]
+    return nodes['Render Layers'].outputs[0]
+
+  def get_backdrop_variant_paths(self):
+    name = os.path.join(self.get_preview_dir(), self.original_object)
+    return {style: f"{name}_backdrop_{style.lower()}.{self.file_format['ext']}" 
+            for style in self.backdrop_colors}
+
+  def set_backdrop_variant_output(self, scene):
+    '''Write the variants of the render in the files of the staged object'''
+    if not self.backdrop_variants_active():
+      return
+    output = scene.node_tree.nodes['NX_BackdropVariants']
+    output.base_path = self.get_preview_dir()
+    for slot, style in zip(output.file_slots, self.backdrop_colors):
+      # the file output adds the frame number
+      slot.path = f"{self.original_object}_backdrop_{style.lower()}_"
+
+  def write_backdrop_variants(self, scene, cache=None, key="", rendered=True):
+    '''Move the variants written by the compositor to their files.
+    Return the paths of the images'''
+    if not self.backdrop_variants_active():
+      return []
+    paths = self.get_backdrop_variant_paths()
+    if (cache is not None and self.use_cache and
+        all(cache.lookup(f"{key}:backdrop:{style}", path) for style, path in paths.items())):
+      return list(paths.values())
+
+    if not rendered:
+      # the preview came from the cache, the variants need a render
+      self.render_again(scene, {'NX_BackdropVariants'})
+
+    with preview_stats.stage("backdrops"):
+      for style, path in paths.items():
+        name = f"{self.original_object}_backdrop_{style.lower()}_{scene.frame_current:04d}"
+        os.replace(os.path.join(self.get_preview_dir(), f"{name}.{self.file_format['ext']}"), path)
+        if cache is not None:
+          cache.add(f"{key}:backdrop:{style}", path)
+    return list(paths.values())
       
-  def add_backdrop(self, context):
-    if "GNX_Backdrop" not in bpy.data.node_groups:
-      backgrop_filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "GNX_Backdrop.blend")
-      with bpy.data.libraries.load(backgrop_filepath, link=False) as (data_from, data_to):
-        data_to.node_groups = [name for name in data_from.node_groups if name == "GNX_Backdrop"]
+  def add_backdrop(self, scene):
+    if 'Backdrop' in scene.objects:
+      backdrop = scene.objects['Backdrop']
+      if backdrop.hide_render:
+        backdrop.hide_render = False
+      node_group = get_backdrop_group()
+      if backdrop.modifiers['NX_Bck'].node_group != node_group:
+        backdrop.modifiers['NX_Bck'].node_group = node_group
+      self.add_material_backdrop(scene)
+      return
 
     if 'Backdrop' not in bpy.data.meshes:
-      bck = bpy.data.meshes.new('Backdrop')
+      bck = tag_data(bpy.data.meshes.new('Backdrop'))
     else:
       bck = bpy.data.meshes['Backdrop']
-    backdrop = bpy.data.objects.new('Backdrop', bck)
-    context.scene.collection.objects.link(backdrop)
-    
-    depsgraph = context.evaluated_depsgraph_get()
-    
-    obj = context.scene.objects['Preview']
-    obj_eval = obj.evaluated_get(depsgraph)
-    scale = obj_eval.scale.z
-    
-    backdrop.location.z =  min([d[2] for d in obj_eval.bound_box]) * scale   
+    backdrop = tag_data(bpy.data.objects.new('Backdrop', bck))
+    scene.collection.objects.link(backdrop)
+
+    self.add_material_backdrop(scene)
 
-    self.add_material_backdrop(context)
-    
     bck_mod = backdrop.modifiers.new('NX_Bck', type="NODES")
-    bck_mod.node_group = bpy.data.node_groups['GNX_Backdrop']   
-    bck_mod["Input_3"] = 5.0 
-    bck_mod["Input_6"] = 0.5 
+    bck_mod.node_group = get_backdrop_group()
+    bck_mod["Input_3"] = 5.0
+    bck_mod["Input_6"] = 0.5
     bck_mod["Input_7"] = 6
     bck_mod["Input_13"] = 1
-    bck_mod["Input_12"] = context.scene.camera
+    bck_mod["Input_12"] = scene.camera
     bck_mod["Input_1"] = bpy.data.materials["MatBackdrop"]
-   
-  def add_background(self, context):
-    scene = context.scene
-    scene.use_nodes = True
+
+  def place_backdrop(self, scene, coords):
+    '''Put the backdrop under the Preview object'''
+    backdrop = scene.objects['Backdrop']
+    backdrop.location.z = float(coords[:, 2].min())
+
+  def add_background(self, scene):
+    if not scene.use_nodes:
+      scene.use_nodes = True
     node_tree = scene.node_tree
     nodes = node_tree.nodes
+
+    changed = self.stage_setting_changed(scene, "background_color", tuple(self.background_color))
+    if 'Mix' in nodes and 'RGB' in nodes:
+      if changed:
+        nodes['RGB'].outputs[0].default_value = self.background_color
+      if nodes['Mix'].inputs[2].links[0].from_socket != self.image_source(scene):
+        node_tree.links.new(nodes['Mix'].inputs[2], self.image_source(scene))
+      self.link_composite(scene, nodes['Mix'].outputs[0])
+      return
+
     nodes.new(type="CompositorNodeImage")
     
     color = nodes.new(type="CompositorNodeRGB")
@@ -313,24 +829,421 @@ class NXBase:
     nodes['Composite'].location.x += 600
 
     node_tree.links.new(nodes['Mix'].inputs[0], nodes['Render Layers'].outputs[1])
-    node_tree.links.new(nodes['Mix'].inputs[2], nodes['Render Layers'].outputs[0])
+    node_tree.links.new(nodes['Mix'].inputs[2], self.image_source(scene))
     node_tree.links.new(nodes['Mix'].inputs[1], nodes['RGB'].outputs[0])
     node_tree.links.new(nodes['Composite'].inputs[0], nodes['Mix'].outputs[0])
 
+  def link_composite(self, scene, source):
+    '''Output the source socket in the render result'''
+    node_tree = scene.node_tree
+    composite = node_tree.nodes['Composite']
+    if len(composite.inputs[0].links) == 0 or composite.inputs[0].links[0].from_socket != source:
+      node_tree.links.new(composite.inputs[0], source)
+
+  def numpy_background(self):
+    '''The background is blended with NumPy on the transparent render, not by the compositor'''
+    return self.use_background and (self.background_compositing == "NUMPY" or self.background_variants)
 
+  def needs_viewer(self):
+    return not self.save_preview_file or self.numpy_background() or self.background_variants
+
+  def add_viewer(self, scene):
+    '''Viewer node of the compositor, its image keeps the pixels of the last render.
+    The render result gets the same image, not a background of a previous preview'''
+    if not scene.use_nodes:
+      scene.use_nodes = True
+    node_tree = scene.node_tree
+    nodes = node_tree.nodes
 
-  def render_preview(self, context):  
+    if 'Viewer' not in nodes:
+      viewer = nodes.new(type="CompositorNodeViewer")
+      viewer.location = nodes['Composite'].location.x, nodes['Composite'].location.y - 200
+    viewer = nodes['Viewer']
+
+    if self.use_background and not self.numpy_background():
+      source = nodes['Mix'].outputs[0]
+    else:
+      source = self.image_source(scene)
+    if len(viewer.inputs[0].links) == 0 or viewer.inputs[0].links[0].from_socket != source:
+      node_tree.links.new(viewer.inputs[0], source)
+    self.link_composite(scene, source)
+
+
+  def get_preview_dir(self):
     p = self.path
     if self.save_in_file_folder and bpy.data.is_saved:
         p = os.path.dirname(bpy.data.filepath)
     elif len(self.path) == 0:
-        p = tempfile.gettempdir()
-    self.preview_filepath = os.path.join(p, self.original_object)
+        p = managed_cache_dir()
+        os.makedirs(p, exist_ok=True)
+    return p
+
+  def evict_cache(self, cache):
+    '''Apply the size and age limits if previews are saved in the managed cache'''
+    if os.path.abspath(cache.directory) != os.path.abspath(managed_cache_dir()):
+      return
+    removed, freed = cache.evict(self.cache_max_size * 1024 * 1024,
+                                 self.cache_max_days * 24 * 3600)
+    if removed > 0:
+      print(f"NX_Preview: {removed} previews removed from cache ({freed / 1024 / 1024:.1f} MB)")
+
+  def set_preview_filepath(self):
+    '''Set preview_filepath (without extension) of the staged object, return the full path'''
+    self.preview_filepath = os.path.join(self.get_preview_dir(), self.original_object)
+    return f"{self.preview_filepath}.{self.file_format['ext']}"
+
+  def render_settings(self):
+    settings = {key: getattr(self, key) for key in self.render_keys}
+    settings["background_color"] = tuple(self.background_color)
+    # only the rendered size changes the image
+    for key in ("resolution", "resolution_percentage", "use_thumbnail_size"):
+      del settings[key]
+    settings["resolution"] = self.render_size()
+    return settings
+
+  def get_cache_key(self, scene):
+    '''Key of the staged object: evaluated mesh, materials and render settings'''
+    with preview_stats.stage("hash"):
+      depsgraph = self.evaluated_depsgraph(scene)
+      obj_eval = scene.objects['Preview'].evaluated_get(depsgraph)
+      settings = self.render_settings()
+      # Standard with the NumPy pixels, else the view transform of the stage
+      settings["view_transform"] = scene.view_settings.view_transform
+      return asset_key(obj_eval, settings)
+
+  def set_render_output(self, scene, invoke=False):
+    scene.render.film_transparent = True
+    scene.render.image_settings.file_format = self.file_format["format"]
+    scene.render.use_lock_interface = not invoke
+
+  def render_preview(self, scene, invoke=False):  
+    '''Render the stage. With invoke, the render runs as a job and
+    the interface stays usable, the end is notified by the render handlers'''
+    self.set_preview_filepath()
+    self.set_render_output(scene, invoke)
+    self.set_backdrop_variant_output(scene)
+    self.set_light_pass_output(scene)
+    scene.render.filepath = self.preview_filepath
+
+    if invoke:
+      # with the NumPy background, the file is written by write_preview_file
+      bpy.ops.render.render('INVOKE_DEFAULT', scene=scene.name, 
+                            write_still=self.save_preview_file and not self.numpy_background())
+      return
+
+    # the file is written after the render to time both separately
+    with preview_stats.stage("render"):
+      bpy.ops.render.render(scene=scene.name)
+    if self.save_preview_file:
+      self.write_preview_file(scene)
+
+  def view_background(self):
+    '''Background color blended with NumPy, None if there is none'''
+    return self.background_color if self.numpy_background() else None
+
+  def background_pixels(self, color):
+    '''Pixels of the last render over color, ready for a PNG file'''
+    return linear_to_srgb(alpha_over(read_viewer_pixels(), color))
+
+  def write_preview_file(self, scene):
+    '''Write the last render in the preview file'''
+    filepath = f"{self.preview_filepath}.{self.file_format['ext']}"
+    with preview_stats.stage("write"):
+      if self.numpy_background():
+        save_pixels(self.background_pixels(self.background_color), filepath)
+      else:
+        bpy.data.images['Render Result'].save_render(filepath, scene=scene)
+
+  def write_background_variants(self, scene, cache=None, key="", rendered=True):
+    '''Write the last render over each background preset, without render by
+    variant. Return the paths of the images written'''
+    if not self.background_variants:
+      return []
+    name = os.path.join(self.get_preview_dir(), self.original_object)
+    paths = {preset: f"{name}_{preset.lower()}.{self.file_format['ext']}" 
+             for preset in self.background_presets}
+    if (cache is not None and self.use_cache and
+        all(cache.lookup(f"{key}:background:{preset}", path) for preset, path in paths.items())):
+      return list(paths.values())
+
+    if not rendered:
+      # the preview came from the cache, the viewer has the pixels of another render
+      self.render_again(scene)
+
+    with preview_stats.stage("backgrounds"):
+      for preset, path in paths.items():
+        save_pixels(self.background_pixels(self.background_presets[preset]), path)
+        if cache is not None:
+          cache.add(f"{key}:background:{preset}", path)
+    return list(paths.values())
+
+  def view_angles(self):
+    '''Rotations of the object around Z of the multi-view renders'''
+    return [2 * np.pi * i / self.view_count for i in range(self.view_count)]
+
+  def turn_object(self, scene, angle):
+    '''Rotate the staged object around Z, its root with the LINK staging'''
+    if self.stage_mode == "LINK":
+      scene.objects['PreviewRoot'].rotation_euler.z = angle
+    else:
+      scene.objects['Preview'].rotation_euler.z = angle
+
+  def get_view_paths(self):
+    '''Files of the multi-view renders: the contact sheet or an image by view'''
+    name = os.path.join(self.get_preview_dir(), self.original_object)
+    if self.multi_view == "SHEET":
+      return [f"{name}_sheet.{self.file_format['ext']}"]
+    return [f"{name}_{i:02d}.{self.file_format['ext']}" for i in range(self.view_count)]
+
+  def render_views(self, scene, cache=None, key=""):
+    '''Render the staged object turned around Z. The object is staged once, 
+    only its rotation and the camera change between the views.
+    Return the paths of the images written'''
+    if self.multi_view == "NONE":
+      return []
+    paths = self.get_view_paths()
+    views_key = f"{key}:{self.multi_view}:{self.view_count}"
+    if (cache is not None and self.use_cache and 
+        all(cache.lookup(f"{views_key}:{i}", path) for i, path in enumerate(paths))):
+      return paths
+
+    self.set_render_output(scene)
+    # the viewer of the sheet uses the compositor, only for the views
+    use_nodes = scene.use_nodes
+    if self.multi_view == "SHEET":
+      self.add_viewer(scene)
+      sheet = new_sheet(self.view_count, self.render_size())
+
+    coords = self.preview_coords(scene)
+    # the views don't write the backdrop variants nor the light passes
+    self.mute_file_outputs(scene)
+    with preview_stats.stage("views"):
+      try:
+        for i, angle in enumerate(self.view_angles()):
+          # the bounds turn with the object, the mesh is not evaluated again
+          self.turn_object(scene, angle)
+          self.frame_cam(scene, rotate_z(coords, angle))
+          bpy.ops.render.render(scene=scene.name)
+          if self.multi_view == "SHEET":
+            paste_tile(sheet, self.background_pixels(self.view_background()), i, self.render_size())
+          elif self.numpy_background():
+            save_pixels(self.background_pixels(self.background_color), paths[i])
+          else:
+            bpy.data.images['Render Result'].save_render(paths[i], scene=scene)
+        if self.multi_view == "SHEET":
+          save_pixels(sheet, paths[0])
+      finally:
+        self.turn_object(scene, 0)
+        self.frame_cam(scene, coords)
+        self.mute_file_outputs(scene, False)
+        if scene.use_nodes != use_nodes:
+          scene.use_nodes = use_nodes
+
+    if cache is not None:
+      for i, path in enumerate(paths):
+        cache.add(f"{views_key}:{i}", path)
+    return paths
+
+  def read_preview_pixels(self):
+    '''Pixels of the last render at the thumbnail size, ready for a preview'''
+    with preview_stats.stage("pixels"):
+      pixels = read_viewer_pixels()
+      if pixels is None:
+        return None
+      pixels = alpha_over(pixels, self.view_background())
+      return linear_to_srgb(downscale(pixels, self.thumbnail_size))
+
+  def will_assign_preview(self, obj):
+    return self.assign_preview and (self.mark_as_asset or obj.asset_data is not None)
+
+  def preview_up_to_date(self, object_name, key):
+    '''Without preview file, the key of the preview is stored on the object'''
+    obj = bpy.data.objects[object_name]
+    return obj.get("nx_preview_key") == key and obj.preview is not None
+
+  def set_rendered_preview(self, object_name, key):
+    '''Write the pixels of the last render in the preview of the object, without file'''
+    obj = bpy.data.objects[object_name]
+    if not self.will_assign_preview(obj):
+      return
+    pixels = self.read_preview_pixels()
+    if pixels is None:
+      print(f"NX_Preview: no rendered pixels for {object_name}")
+      return
+    set_preview_pixels(obj, pixels)
+    obj["nx_preview_key"] = key
+
+  def build_stage(self, context):
+    '''Create the preview scene with camera, lights, world and backdrop.
+    The scene is kept between renders, only the settings which have changed are updated'''
+    self.create_scene_and_switch_to(context, self.scene_preview)
+    scene = self.get_stage()
+
+    with preview_stats.stage("camera"):
+      self.add_cam(scene)
+
+    self.set_render_profile(scene)
+    self.set_color_management(scene)
+
+    with preview_stats.stage("lights"):
+      self.add_light(scene, "Area_1", loc=(0,-1,3), rot=(18.7,0,0), size=2, 
+                      energy=self.light_top_strength, energy_max=75)
+      self.add_light(scene, "Area_2", loc=(-2,-3,3), rot=(34.2,0,-58.6), size=0.25, 
+                      energy=self.light_left_strength, energy_max=150)
+      self.add_light(scene, "Area_3", loc=(4,0,1), rot=(0,75,0), size=0.25, 
+                      energy=self.light_right_strength, energy_max=100)
+
+    with preview_stats.stage("world"):
+      self.add_world(scene)
+
+    if self.use_backdrop:
+      with preview_stats.stage("backdrop"):
+        self.add_backdrop(scene)
+    elif 'Backdrop' in scene.objects:
+      if not scene.objects['Backdrop'].hide_render:
+        scene.objects['Backdrop'].hide_render = True
+
+    if self.backdrop_variants_active():
+      self.add_backdrop_variants(scene)
+    if self.relight_active(scene):
+      self.add_light_groups(scene)
+    self.mute_file_outputs(scene, False)
+    
+    if self.use_background and not self.numpy_background():
+      self.add_background(scene)
+    elif self.needs_viewer() or self.backdrop_variants_active() or self.relight_active(scene):
+      self.add_viewer(scene)
+      # the transparent render, without the background of a previous preview
+      self.link_composite(scene, self.image_source(scene))
+    elif scene.use_nodes:
+      scene.use_nodes = False
+
+    if self.needs_viewer():
+      self.add_viewer(scene)
+
+  def stage_object(self, scene, object_name):
+    '''Replace the Preview object of the stage by a copy of object_name'''
+    self.original_object = object_name
+    self.remove_preview_object(scene)
+
+    with preview_stats.stage("copy"):
+      self.copy_object(scene)
+
+    with preview_stats.stage("framing"):
+      coords = self.preview_coords(scene)
+      self.frame_cam(scene, coords)
+
+      if self.use_backdrop:
+        self.place_backdrop(scene, coords)
+
+  def remove_preview_object(self, scene):
+    with preview_stats.stage("purge"):
+      if 'Preview' in scene.objects:
+        bpy.data.objects.remove(scene.objects['Preview'], do_unlink=True)
+      self.free_run_data()
+
+  def clear_stage(self):
+    '''Remove the preview scene and the data it used, with the pinned resources'''
+    if self.scene_preview not in bpy.data.scenes:
+      return
+    remove_stage(self.scene_preview)
+
+  def assign_asset_preview(self, object_name, filepath):
+    obj = bpy.data.objects[object_name]
+    if self.mark_as_asset or obj.asset_data is not None:
+      obj.asset_mark()
+    
+      if self.assign_preview:
+        # without file, the preview has been set by set_rendered_preview
+        if os.path.isfile(filepath):
+          with preview_stats.stage("assign", object_name):
+            bpy.ops.ed.lib_id_load_custom_preview(
+              {"id":obj}, 
+              filepath=filepath
+            )
+      else:
+        obj.asset_generate_preview()
+
+  def save_asset_in_library(self, object_name, filepath):
+    if not self.save_asset:
+      return
+    with preview_stats.stage("save_asset", object_name):
+      bpy.ops.asset.nx_asset_save(
+                                  save_asset=self.save_asset,
+                                  filepath=filepath,
+                                  assign_preview=self.assign_preview,
+                                  library_id=self.library_id,
+                                  original_scene=self.original_scene,
+                                  original_object=object_name,
+                                  apply_modifiers=self.apply_modifier
+                                )
+
+  def report_write_failures(self, wait=False):
+    '''Report the library files not copied by the writer,
+    wait for the pending files if wait is True'''
+    failures = library_writer.flush() if wait else library_writer.take_failures()
+    if len(failures) > 0:
+      names = ", ".join(os.path.basename(filepath) for filepath, error in failures)
+      self.report({'WARNING'}, f"{len(failures)} library files not saved: {names}")
+    return failures
+
+  def export_assets_in_library(self, object_names):
+    '''Save the assets of a batch, one write by file of the library'''
+    if not self.save_asset or len(object_names) == 0:
+      return
+    # the assets are written in bulk, each one gets its share of the time
+    with preview_stats.shared_stage("save_asset", object_names):
+      if self.sync_library:
+        # all the new or changed assets of the file
+        bpy.ops.asset.nx_library_sync(
+                                      layout=self.export_layout,
+                                      file_name=self.export_file_name,
+                                      assign_preview=self.assign_preview,
+                                      library_id=self.library_id,
+                                      apply_modifiers=self.apply_modifier
+                                    )
+        return
+      bpy.ops.asset.nx_asset_export(
+                                    objects=[{"name": name} for name in object_names],
+                                    layout=self.export_layout,
+                                    file_name=self.export_file_name,
+                                    assign_preview=self.assign_preview,
+                                    library_id=self.library_id,
+                                    apply_modifiers=self.apply_modifier
+                                  )
+
+
+def remove_stage(scene_name=NXBase.scene_preview):
+  '''Remove the preview scene, the data it used and the pinned resources.
+  The windows showing the scene switch to another one'''
+  scene = bpy.data.scenes.get(scene_name)
+  if scene is not None:
+    others = [s for s in bpy.data.scenes if s != scene]
+    for window in bpy.context.window_manager.windows:
+      if window.scene == scene and len(others) > 0:
+        window.scene = others[0]
+    for obj in list(scene.objects):
+      bpy.data.objects.remove(obj, do_unlink=True)
+    bpy.data.scenes.remove(scene, do_unlink=True)
+  removed = data_registry.free() + free_tagged("stage") + release_resources()
+  if removed > 0:
+    print(f"NX_Preview: preview stage removed, {removed} datablocks")
+
+
+@persistent
+def on_save_pre(*args):
+  '''The stage and its resources are kept for the session, not saved in the file'''
+  if render_queue.running:
+    print("NX_Preview: the render queue is running, the preview stage is saved with the file")
+    return
+  remove_stage()
+
+
+def register_handlers():
+  if on_save_pre not in bpy.app.handlers.save_pre:
+    bpy.app.handlers.save_pre.append(on_save_pre)
 
-    context.scene.render.film_transparent = True
-    context.scene.render.image_settings.file_format = self.file_format["format"]
-    context.scene.render.filepath = self.preview_filepath
 
-    context.scene.render.use_lock_interface = True
-    bpy.ops.render.render(write_still = True)
- 
\ No newline at end of file
+def unregister_handlers():
+  if on_save_pre in bpy.app.handlers.save_pre:
+    bpy.app.handlers.save_pre.remove(on_save_pre)
@@ -0,0 +1,379 @@
+'''Benchmark of the preview pipeline on synthetic corpora.
+
+Run in background Blender, the results are written in a JSON file:
+
+  blender -b --factory-startup --python nxbench.py -- run \
+          --corpora low,high,modifiers,geonodes,materials --counts 10,100 \
+          --profiles EEVEE,DRAFT --output bench.json
+
+Compare two results, exit code 1 on regression (no Blender needed):
+
+  python nxbench.py compare baseline.json bench.json --threshold 0.1
+
+Each case (corpus, count, profile) runs in a new Blender process, so its peak
+memory doesn't depend on the cases run before. The corpus is generated with a
+fixed seed, rendered by the batch operator with the cache disabled, then
+removed. The latency of an asset includes the staging, the render, the preview
+assignment and its share of the asset save (--save-assets).
+'''
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+CORPORA = ("low", "high", "modifiers", "geonodes", "materials")
+RESULTS_VERSION = 1
+
+
+def percentile(values, p):
+  '''Nearest rank percentile'''
+  if len(values) == 0:
+    return 0.0
+  values = sorted(values)
+  return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+# corpus generation, Blender only
+
+def ico_mesh(name, subdivisions):
+  import bmesh
+  import bpy
+  bm = bmesh.new()
+  bmesh.ops.create_icosphere(bm, subdivisions=subdivisions, radius=1.0)
+  mesh = bpy.data.meshes.new(name)
+  bm.to_mesh(mesh)
+  bm.free()
+  return mesh
+
+
+def cube_mesh(name):
+  import bmesh
+  import bpy
+  bm = bmesh.new()
+  bmesh.ops.create_cube(bm, size=2.0)
+  mesh = bpy.data.meshes.new(name)
+  bm.to_mesh(mesh)
+  bm.free()
+  return mesh
+
+
+def geometry_node_group():
+  '''Scatter small spheres on the faces of the mesh'''
+  import bpy
+  if "NXBenchScatter" in bpy.data.node_groups:
+    return bpy.data.node_groups["NXBenchScatter"]
+  group = bpy.data.node_groups.new("NXBenchScatter", "GeometryNodeTree")
+  if hasattr(group, "interface"):
+    group.interface.new_socket("Geometry", in_out="INPUT", socket_type="NodeSocketGeometry")
+    group.interface.new_socket("Geometry", in_out="OUTPUT", socket_type="NodeSocketGeometry")
+  else:
+    group.inputs.new("NodeSocketGeometry", "Geometry")
+    group.outputs.new("NodeSocketGeometry", "Geometry")
+
+  nodes = group.nodes
+  node_input = nodes.new("NodeGroupInput")
+  node_output = nodes.new("NodeGroupOutput")
+  distribute = nodes.new("GeometryNodeDistributePointsOnFaces")
+  distribute.inputs["Density"].default_value = 50
+  sphere = nodes.new("GeometryNodeMeshIcoSphere")
+  sphere.inputs["Radius"].default_value = 0.05
+  sphere.inputs["Subdivisions"].default_value = 2
+  instance = nodes.new("GeometryNodeInstanceOnPoints")
+  realize = nodes.new("GeometryNodeRealizeInstances")
+  join = nodes.new("GeometryNodeJoinGeometry")
+
+  links = group.links
+  links.new(node_input.outputs[0], distribute.inputs["Mesh"])
+  links.new(distribute.outputs["Points"], instance.inputs["Points"])
+  links.new(sphere.outputs["Mesh"], instance.inputs["Instance"])
+  links.new(instance.outputs["Instances"], realize.inputs["Geometry"])
+  links.new(realize.outputs["Geometry"], join.inputs["Geometry"])
+  links.new(node_input.outputs[0], join.inputs["Geometry"])
+  links.new(join.outputs["Geometry"], node_output.inputs[0])
+  return group
+
+
+def add_materials(mesh, count, rng):
+  import bpy
+  import numpy as np
+  for i in range(count):
+    mat = bpy.data.materials.new(f"{mesh.name}_mat_{i}")
+    mat.use_nodes = True
+    mat.node_tree.nodes["Principled BSDF"].inputs[0].default_value = (
+      rng.random(), rng.random(), rng.random(), 1.0)
+    mesh.materials.append(mat)
+  indices = np.arange(len(mesh.polygons), dtype=np.int32) % count
+  mesh.polygons.foreach_set("material_index", indices)
+
+
+def make_object(corpus, index, rng):
+  import bpy
+  name = f"{corpus}_{index:05d}"
+  if corpus == "low":
+    obj = bpy.data.objects.new(name, ico_mesh(name, 2))
+  elif corpus == "high":
+    obj = bpy.data.objects.new(name, ico_mesh(name, 6))
+  elif corpus == "modifiers":
+    obj = bpy.data.objects.new(name, cube_mesh(name))
+    bevel = obj.modifiers.new("Bevel", type="BEVEL")
+    bevel.width = 0.1
+    bevel.segments = 3
+    array = obj.modifiers.new("Array", type="ARRAY")
+    array.count = 3
+    subsurf = obj.modifiers.new("Subdivision", type="SUBSURF")
+    subsurf.levels = 2
+    subsurf.render_levels = 2
+  elif corpus == "geonodes":
+    obj = bpy.data.objects.new(name, ico_mesh(name, 2))
+    modifier = obj.modifiers.new("Scatter", type="NODES")
+    modifier.node_group = geometry_node_group()
+  elif corpus == "materials":
+    obj = bpy.data.objects.new(name, ico_mesh(name, 3))
+    add_materials(obj.data, 16, rng)
+  else:
+    raise ValueError(f"Unknown corpus '{corpus}'")
+  obj.rotation_euler = (rng.random(), rng.random(), rng.random())
+  obj.scale = (0.5 + rng.random(),) * 3
+  return obj
+
+
+def generate_corpus(corpus, count, seed=0):
+  '''Create count objects of the corpus in a new collection of the scene'''
+  import bpy
+  rng = random.Random(f"{corpus}-{seed}")
+  collection = bpy.data.collections.new(f"NXBench_{corpus}")
+  bpy.context.scene.collection.children.link(collection)
+  for i in range(count):
+    collection.objects.link(make_object(corpus, i, rng))
+  return collection
+
+
+def remove_corpus(collection):
+  '''Remove the collection, its objects and their data'''
+  import bpy
+  ids = [collection]
+  for obj in collection.objects:
+    ids.append(obj)
+    if obj.data is not None:
+      ids.append(obj.data)
+      ids += [mat for mat in getattr(obj.data, "materials", []) if mat is not None]
+  bpy.data.batch_remove(set(ids))
+  if "NXBenchScatter" in bpy.data.node_groups:
+    bpy.data.node_groups.remove(bpy.data.node_groups["NXBenchScatter"])
+
+
+def add_library(directory):
+  '''Temporary asset library, return its index'''
+  import bpy
+  libraries = bpy.context.preferences.filepaths.asset_libraries
+  bpy.ops.preferences.asset_library_add(directory=directory)
+  return len(libraries) - 1
+
+
+def bench_case(corpus, count, profile, settings, workdir, library_id=-1, seed=0):
+  '''Render one corpus with one profile, return the measures'''
+  import bpy
+  collection = generate_corpus(corpus, count, seed)
+  name = f"{corpus}_{count}_{profile}"
+  stats_path = os.path.join(workdir, f"{name}_stats.json")
+  report_path = os.path.join(workdir, f"{name}_report.json")
+  output = os.path.join(workdir, name)
+  os.makedirs(output, exist_ok=True)
+
+  start = time.perf_counter()
+  try:
+    bpy.ops.object.nx_preview_batch(
+      collection=collection.name,
+      report_path=report_path,
+      stats_path=stats_path,
+      path=output,
+      render_profile=profile,
+      use_cache=False,
+      mark_as_asset=True,
+      save_asset=library_id >= 0,
+      library_id=max(library_id, 0),
+      **settings
+    )
+  finally:
+    seconds = time.perf_counter() - start
+    remove_corpus(collection)
+
+  with open(stats_path) as f:
+    stats = json.load(f)
+  with open(report_path) as f:
+    report = json.load(f)
+
+  latencies = [a["seconds"] + a["stages"].get("assign", 0) + a["stages"].get("save_asset", 0)
+                 for a in stats["assets"]]
+  render_peaks = [a["render_peak_mb"] for a in stats["assets"]]
+  return {
+    "corpus": corpus,
+    "count": count,
+    "profile": profile,
+    "assets": len(report),
+    "failed": len([r for r in report if r["status"] == "failed"]),
+    "seconds": round(seconds, 3),
+    "throughput": round(len(report) / seconds, 3) if seconds > 0 else 0.0,
+    "p50": round(percentile(latencies, 50), 4),
+    "p95": round(percentile(latencies, 95), 4),
+    "peak_memory_mb": stats["summary"]["peak_memory_mb"],
+    "render_peak_mb": max(render_peaks) if len(render_peaks) > 0 else 0.0,
+    "stages": stats["summary"]["stages"]
+  }
+
+
+def bench_settings(settings_path):
+  '''Preview settings of the file, without the ones set by the benchmark'''
+  sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+  import nxpreview_cli
+  nxpreview_cli.ensure_addon()
+  settings = nxpreview_cli.operator_settings(nxpreview_cli.load_settings(settings_path))
+  for key in ("render_profile", "use_cache", "path", "mark_as_asset", "save_asset", "library_id",
+              "report_path", "stats_path", "collection"):
+    settings.pop(key, None)
+  return settings
+
+
+def case_command(args, corpus, count, profile, workdir, result_path):
+  '''Blender command rendering one case in a new process'''
+  import bpy
+  command = [bpy.app.binary_path, "-b", "--factory-startup",
+             "--python", os.path.abspath(__file__), "--", "case",
+             "--corpus", corpus, "--count", str(count), "--profile", profile,
+             "--settings", args.settings, "--seed", str(args.seed),
+             "--workdir", workdir, "--output", result_path]
+  return command + (["--save-assets"] if args.save_assets else [])
+
+
+def case(args):
+  '''Render one case and write its measures, in the Blender process of the case'''
+  settings = bench_settings(args.settings)
+  library_id = -1
+  if args.save_assets:
+    library_dir = os.path.join(args.workdir, "library")
+    os.makedirs(library_dir, exist_ok=True)
+    library_id = add_library(library_dir)
+  result = bench_case(args.corpus, args.count, args.profile, settings, args.workdir,
+                      library_id, args.seed)
+  with open(args.output, "w") as f:
+    json.dump(result, f, indent=2)
+  return 0
+
+
+def run(args):
+  import bpy
+  settings = bench_settings(args.settings)
+  workdir = args.workdir or tempfile.mkdtemp(prefix="nxbench_")
+
+  results = []
+  errors = 0
+  for corpus in args.corpora.split(","):
+    for count in [int(c) for c in args.counts.split(",")]:
+      for profile in args.profiles.split(","):
+        print(f"NX_Bench: {corpus} x{count} {profile}")
+        result_path = os.path.join(workdir, f"{corpus}_{count}_{profile}_result.json")
+        if os.path.isfile(result_path):
+          os.remove(result_path)
+        subprocess.run(case_command(args, corpus, count, profile, workdir, result_path))
+        if not os.path.isfile(result_path):
+          print(f"NX_Bench: {corpus} x{count} {profile} failed, no result")
+          errors += 1
+          continue
+        with open(result_path) as f:
+          result = json.load(f)
+        print(f"NX_Bench: {result['throughput']:.2f} assets/s, p50 {result['p50']:.3f}s, "
+              f"p95 {result['p95']:.3f}s, {result['peak_memory_mb']:.0f} MB")
+        results.append(result)
+
+  output = {
+    "version": RESULTS_VERSION,
+    "blender": bpy.app.version_string,
+    "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "seed": args.seed,
+    "settings": settings,
+    "results": results
+  }
+  with open(args.output, "w") as f:
+    json.dump(output, f, indent=2)
+  print(f"NX_Bench: results written in {args.output}")
+  return 1 if errors > 0 or any(r["failed"] > 0 for r in results) else 0
+
+
+def compare(args):
+  '''Compare the cases found in both files, a regression is a change over threshold'''
+  with open(args.baseline) as f:
+    baseline = {(r["corpus"], r["count"], r["profile"]): r for r in json.load(f)["results"]}
+  with open(args.current) as f:
+    current = {(r["corpus"], r["count"], r["profile"]): r for r in json.load(f)["results"]}
+
+  # measure, True if higher is better
+  measures = (("throughput", True), ("p50", False), ("p95", False), ("peak_memory_mb", False))
+  regressions = 0
+  for key in sorted(set(baseline) & set(current)):
+    print(f"{key[0]} x{key[1]} {key[2]}")
+    for measure, higher_is_better in measures:
+      before, after = baseline[key][measure], current[key][measure]
+      change = (after - before) / before if before > 0 else 0.0
+      regression = change < -args.threshold if higher_is_better else change > args.threshold
+      regressions += regression
+      print(f"  {measure:<15} {before:>10.3f} {after:>10.3f} {change:+8.1%}{'  REGRESSION' if regression else ''}")
+
+  for key in sorted(set(baseline) ^ set(current)):
+    print(f"{key[0]} x{key[1]} {key[2]}: only in {'baseline' if key in baseline else 'current'}")
+  print(f"NX_Bench: {regressions} regressions")
+  return 1 if regressions > 0 else 0
+
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(prog="nxbench", description="NX_Preview benchmark")
+  commands = parser.add_subparsers(dest="command", required=True)
+
+  run_parser = commands.add_parser("run", help="render the corpora, in background Blender")
+  run_parser.add_argument("--corpora", default=",".join(CORPORA),
+                          help=f"comma separated corpora: {', '.join(CORPORA)}")
+  run_parser.add_argument("--counts", default="10", help="comma separated numbers of objects")
+  run_parser.add_argument("--profiles", default="EEVEE,DRAFT", help="comma separated render profiles")
+  run_parser.add_argument("--settings", default="", help="JSON or TOML preview settings")
+  run_parser.add_argument("--save-assets", action="store_true",
+                          help="also save the assets in a temporary library")
+  run_parser.add_argument("--seed", type=int, default=0, help="seed of the corpora")
+  run_parser.add_argument("--workdir", default="", help="folder of the previews and logs")
+  run_parser.add_argument("--output", default="nxbench.json", help="JSON results")
+
+  case_parser = commands.add_parser("case", help="render one case, run by the run command")
+  case_parser.add_argument("--corpus", choices=CORPORA, required=True)
+  case_parser.add_argument("--count", type=int, required=True)
+  case_parser.add_argument("--profile", required=True)
+  case_parser.add_argument("--settings", default="")
+  case_parser.add_argument("--save-assets", action="store_true")
+  case_parser.add_argument("--seed", type=int, default=0)
+  case_parser.add_argument("--workdir", required=True)
+  case_parser.add_argument("--output", required=True, help="JSON measures of the case")
+
+  compare_parser = commands.add_parser("compare", help="compare two results")
+  compare_parser.add_argument("baseline", help="JSON results of reference")
+  compare_parser.add_argument("current", help="JSON results to check")
+  compare_parser.add_argument("--threshold", type=float, default=0.1,
+                              help="relative change considered as a regression")
+  return parser.parse_args(argv)
+
+
+def main(argv=None):
+  if argv is None:
+    # arguments after -- when run by Blender
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else sys.argv[1:]
+  args = parse_args(argv)
+  if args.command == "compare":
+    return compare(args)
+  if args.command == "case":
+    return case(args)
+  return run(args)
+
+
+if __name__ == "__main__":
+  sys.exit(main())
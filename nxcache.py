@@ -0,0 +1,297 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+import numpy as np
+import bpy
+
+# change it when the render pipeline changes to invalidate all the previews
+CACHE_VERSION = 1
+INDEX_NAME = ".nx_preview_cache.json"
+MANAGED_DIR_NAME = "NX_Preview"
+# seconds to wait for the index lock, and age of a lock left by a crashed process
+LOCK_TIMEOUT = 30
+LOCK_STALE = 120
+
+# node properties without effect on the render
+NODE_PROPS_SKIPPED = {
+  "name", "label", "location", "width", "width_hidden", "height", "select",
+  "show_options", "show_preview", "show_texture", "hide", "color", "use_custom_color"
+}
+
+
+def managed_cache_dir():
+  '''Folder of the previews when no output folder is selected'''
+  return os.path.join(tempfile.gettempdir(), MANAGED_DIR_NAME)
+
+
+def to_hashable(value):
+  if isinstance(value, (str, int, float, bool)) or value is None:
+    return value
+  if isinstance(value, set):
+    return sorted(value)
+  if hasattr(value, "name") and isinstance(value, bpy.types.ID):
+    return value.name
+  try:
+    return [to_hashable(v) for v in value]
+  except TypeError:
+    return repr(value)
+
+
+def hash_array(h, collection, attr, dtype, size=1):
+  data = np.empty(len(collection) * size, dtype=dtype)
+  collection.foreach_get(attr, data)
+  h.update(data.tobytes())
+
+
+def hash_mesh(h, mesh):
+  hash_array(h, mesh.vertices, "co", np.float32, 3)
+  hash_array(h, mesh.loops, "vertex_index", np.int32)
+  hash_array(h, mesh.polygons, "loop_total", np.int32)
+  hash_array(h, mesh.polygons, "material_index", np.int32)
+  hash_array(h, mesh.polygons, "use_smooth", bool)
+  for uv_layer in mesh.uv_layers:
+    hash_array(h, uv_layer.data, "uv", np.float32, 2)
+  h.update(repr((getattr(mesh, "use_auto_smooth", False),
+                 getattr(mesh, "auto_smooth_angle", 0))).encode())
+
+
+def hash_image(h, image):
+  h.update(image.name.encode())
+  h.update(image.filepath.encode())
+  if image.packed_file is not None:
+    h.update(str(image.packed_file.size).encode())
+  else:
+    filepath = bpy.path.abspath(image.filepath, library=image.library)
+    if os.path.isfile(filepath):
+      h.update(str(os.path.getmtime(filepath)).encode())
+
+
+def hash_node_tree(h, node_tree, seen):
+  if node_tree.name in seen:
+    return
+  seen.add(node_tree.name)
+
+  for node in sorted(node_tree.nodes, key=lambda n: n.name):
+    h.update(node.bl_idname.encode())
+    h.update(node.name.encode())
+    for prop in node.bl_rna.properties:
+      if (prop.identifier in NODE_PROPS_SKIPPED or prop.is_readonly or
+          prop.type not in {"BOOLEAN", "INT", "FLOAT", "STRING", "ENUM"}):
+        continue
+      h.update(repr(to_hashable(getattr(node, prop.identifier))).encode())
+    for socket in node.inputs:
+      if hasattr(socket, "default_value"):
+        h.update(repr(to_hashable(socket.default_value)).encode())
+    if getattr(node, "image", None) is not None:
+      hash_image(h, node.image)
+    if getattr(node, "node_tree", None) is not None:
+      hash_node_tree(h, node.node_tree, seen)
+
+  for link in node_tree.links:
+    h.update(f"{link.from_node.name}:{link.from_socket.identifier}>"
+             f"{link.to_node.name}:{link.to_socket.identifier}".encode())
+
+
+def hash_material(h, material, seen):
+  if material is None:
+    h.update(b"None")
+    return
+  h.update(material.name.encode())
+  h.update(repr(to_hashable(material.diffuse_color)).encode())
+  if material.use_nodes and material.node_tree is not None:
+    hash_node_tree(h, material.node_tree, seen)
+
+
+def asset_key(obj_eval, settings):
+  '''Hash of the evaluated mesh, its materials and the render settings'''
+  h = hashlib.sha1()
+  h.update(json.dumps({"version": CACHE_VERSION, "settings": settings},
+                      sort_keys=True).encode())
+  h.update(repr(to_hashable(obj_eval.matrix_world)).encode())
+
+  if obj_eval.type == 'MESH':
+    # the evaluated mesh is read in place, a copy would double the memory of huge meshes
+    hash_mesh(h, obj_eval.data)
+  else:
+    # curves and texts are converted, empties, lights and cameras have no mesh:
+    # the transform and settings only
+    mesh = obj_eval.to_mesh()
+    try:
+      if mesh is not None:
+        hash_mesh(h, mesh)
+      else:
+        h.update(obj_eval.type.encode())
+    finally:
+      obj_eval.to_mesh_clear()
+
+  seen = set()
+  for slot in obj_eval.material_slots:
+    hash_material(h, slot.material, seen)
+
+  return h.hexdigest()
+
+
+class PreviewCache:
+  '''Index of the previews of a folder, keyed by asset key.
+  Each entry stores the path, size, render time and last access of the preview.
+  Several processes can share the folder (render farm): the keys changed and
+  removed by this one are merged in the index on save, under a lock file'''
+  def __init__(self, directory):
+    self.directory = directory
+    self.index_path = os.path.join(directory, INDEX_NAME)
+    self.lock_path = f"{self.index_path}.lock"
+    self.entries = self.read_index()
+    self.changed = set()
+    self.removed = set()
+
+  def read_index(self):
+    if not os.path.isfile(self.index_path):
+      return {}
+    try:
+      with open(self.index_path) as f:
+        return json.load(f)
+    except ValueError:
+      print(f"NX_Preview: invalid cache index {self.index_path}, ignored")
+      return {}
+
+  def discard(self, key):
+    del self.entries[key]
+    self.changed.discard(key)
+    self.removed.add(key)
+
+  def lookup(self, key, filepath):
+    '''Return True if a preview for key exists, copy it to filepath if needed'''
+    entry = self.entries.get(key)
+    if entry is None:
+      return False
+    if not os.path.isfile(entry["path"]):
+      self.discard(key)
+      return False
+    if os.path.abspath(entry["path"]) != os.path.abspath(filepath):
+      # the file is overwritten, as in add()
+      for k in [k for k, e in self.entries.items() if e["path"] == filepath]:
+        self.discard(k)
+      shutil.copyfile(entry["path"], filepath)
+    entry["last_access"] = time.time()
+    self.changed.add(key)
+    return True
+
+  def add(self, key, filepath, render_time=0.0):
+    # the file is overwritten, the previous key of this file is no longer valid
+    for k in [k for k, e in self.entries.items() if e["path"] == filepath]:
+      self.discard(k)
+    self.entries[key] = {
+      "path": filepath,
+      "size": os.path.getsize(filepath) if os.path.isfile(filepath) else 0,
+      "render_time": round(render_time, 3),
+      "last_access": time.time()
+    }
+    self.removed.discard(key)
+    self.changed.add(key)
+
+  def size(self):
+    return sum(e.get("size", 0) for e in self.entries.values())
+
+  def is_managed(self, filepath):
+    '''Only the files of the cache folder can be deleted'''
+    directory = os.path.abspath(self.directory)
+    return os.path.commonpath([directory, os.path.abspath(filepath)]) == directory
+
+  def remove(self, key):
+    entry = self.entries[key]
+    self.discard(key)
+    if self.is_managed(entry["path"]) and os.path.isfile(entry["path"]):
+      os.remove(entry["path"])
+    return entry.get("size", 0)
+
+  def evict(self, max_size=0, max_age=0):
+    '''Remove the previews not accessed since max_age seconds, then the least
+    recently used ones until the cache is under max_size bytes. 0 is no limit.
+    Return the number of previews removed and the bytes freed'''
+    removed = 0
+    freed = 0
+    for key in [k for k, e in self.entries.items() if not os.path.isfile(e["path"])]:
+      self.discard(key)
+
+    lru = sorted(self.entries, key=lambda k: self.entries[k].get("last_access", 0))
+    if max_age > 0:
+      limit = time.time() - max_age
+      for key in [k for k in lru if self.entries[k].get("last_access", 0) < limit]:
+        freed += self.remove(key)
+        removed += 1
+        lru.remove(key)
+
+    if max_size > 0:
+      size = self.size()
+      while size > max_size and len(lru) > 0:
+        entry_size = self.remove(lru.pop(0))
+        size -= entry_size
+        freed += entry_size
+        removed += 1
+
+    return removed, freed
+
+  def clear(self):
+    '''Remove all the previews, also the ones missing in the index'''
+    removed = len(self.entries)
+    freed = sum(self.remove(key) for key in list(self.entries))
+    if os.path.isdir(self.directory):
+      for name in os.listdir(self.directory):
+        filepath = os.path.join(self.directory, name)
+        # the index, its lock and the files being written by other processes
+        if not name.startswith(INDEX_NAME) and os.path.isfile(filepath):
+          freed += os.path.getsize(filepath)
+          os.remove(filepath)
+          removed += 1
+    return removed, freed
+
+  @contextmanager
+  def locked(self):
+    '''Hold the lock file of the index, a lock older than LOCK_STALE is broken'''
+    start = time.time()
+    while True:
+      try:
+        fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        break
+      except FileExistsError:
+        try:
+          if time.time() - os.path.getmtime(self.lock_path) > LOCK_STALE:
+            os.remove(self.lock_path)
+            continue
+        except OSError:
+          continue
+        if time.time() - start > LOCK_TIMEOUT:
+          raise TimeoutError(f"cache index locked: {self.lock_path}")
+        time.sleep(0.05)
+    try:
+      os.close(fd)
+      yield
+    finally:
+      os.remove(self.lock_path)
+
+  def merge(self, entries):
+    '''Apply the changes of this process to the entries read from the index'''
+    for key in self.removed:
+      entries.pop(key, None)
+    changed = {k: self.entries[k] for k in self.changed if k in self.entries}
+    # a file written by this process replaces the keys of the other ones
+    paths = {e["path"] for e in changed.values()}
+    for key in [k for k, e in entries.items() if e["path"] in paths and k not in changed]:
+      del entries[key]
+    entries.update(changed)
+    return entries
+
+  def save(self):
+    os.makedirs(self.directory, exist_ok=True)
+    with self.locked():
+      self.entries = self.merge(self.read_index())
+      tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+      with open(tmp_path, "w") as f:
+        json.dump(self.entries, f, indent=1)
+      os.replace(tmp_path, self.index_path)
+    self.changed = set()
+    self.removed = set()
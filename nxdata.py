@@ -0,0 +1,98 @@
+'''Datablocks created by the addon.
+
+The datablocks of a preview run (copy of the object, its mesh, asset scene) are
+tracked by the registry and removed by free(), without scanning bpy.data and
+without touching the orphan data of the user. The datablocks of the preview
+stage are tagged and removed with the stage.
+'''
+import bpy
+
+TAG = "nx_preview_data"
+
+ID_COLLECTIONS = {
+  "OBJECT": "objects",
+  "MESH": "meshes",
+  "LIGHT": "lights",
+  "CAMERA": "cameras",
+  "NODETREE": "node_groups",
+  "WORLD": "worlds",
+  "IMAGE": "images",
+  "MATERIAL": "materials",
+  "SCENE": "scenes"
+}
+
+
+def tag_data(id_data, group="stage"):
+  id_data[TAG] = group
+  return id_data
+
+
+class DataRegistry:
+  '''Datablocks created by the current preview run, by collection and name'''
+  def __init__(self):
+    self.ids = []
+
+  def track(self, id_data):
+    tag_data(id_data, "run")
+    self.ids.append((ID_COLLECTIONS[id_data.id_type], id_data.name))
+    return id_data
+
+  def free(self):
+    '''Remove the tracked datablocks without users, the others stay tracked.
+    Return the number of datablocks removed'''
+    removed = 0
+    kept = []
+    # objects first, their data become orphan
+    for collection_name, name in sorted(self.ids, key=lambda i: i[0] != "objects"):
+      id_data = getattr(bpy.data, collection_name).get(name)
+      if id_data is None or id_data.get(TAG) != "run":
+        continue
+      if id_data.users > 0:
+        kept.append((collection_name, name))
+        continue
+      getattr(bpy.data, collection_name).remove(id_data, do_unlink=True)
+      removed += 1
+    self.ids = kept
+    return removed
+
+
+data_registry = DataRegistry()
+
+
+def free_tagged(group="stage"):
+  '''Remove the datablocks tagged with group, scan the collections used by the addon'''
+  removed = 0
+  for collection_name in ID_COLLECTIONS.values():
+    collection = getattr(bpy.data, collection_name)
+    for id_data in [d for d in collection if d.get(TAG) == group]:
+      collection.remove(id_data, do_unlink=True)
+      removed += 1
+  return removed
+
+
+def purge_orphan_data():
+  '''Remove all the datablocks without users, whoever created them.
+  The data of the preview stage are kept'''
+  print("====PURGE_ORPHAN_DATA====")
+  removed = 0
+
+  meshes = [mesh for mesh in bpy.data.meshes if mesh.users == 0 and mesh.name != "Backdrop"]
+  lights = [light for light in bpy.data.lights if light.users == 0 and
+            light.name not in ["Area_1","Area_2","Area_3"]]
+  cam_objects = [cam for cam in bpy.data.objects if cam.type == "CAMERA" and cam.users == 0]
+  cams = [cam for cam in bpy.data.cameras if cam.users == 0 and cam.name != "CamPreview"]
+  ngs = [ng for ng in bpy.data.node_groups if ng.users == 0 and ng.name != "GNX_Backdrop"]
+  worlds = [world for world in bpy.data.worlds if world.users == 0 and world.name != "WorldPreview"]
+  imgs = [img for img in bpy.data.images if img.users == 0]
+
+  for collection, ids in ((bpy.data.objects, cam_objects),
+                          (bpy.data.meshes, meshes),
+                          (bpy.data.lights, lights),
+                          (bpy.data.cameras, cams),
+                          (bpy.data.node_groups, ngs),
+                          (bpy.data.worlds, worlds),
+                          (bpy.data.images, imgs)):
+    for id_data in ids:
+      collection.remove(id_data, do_unlink=True)
+      removed += 1
+  return removed
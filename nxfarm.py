@@ -0,0 +1,259 @@
+'''Render farm coordinator, shard a library across background Blender workers.
+
+  python nxfarm.py run --blender /path/to/blender --workers 16 \
+                       --settings settings.json --output previews/ library/
+
+The assets are listed by the workers (nxpreview_cli.py --list), split in
+shards and rendered by --workers Blender processes at the same time. Failed
+assets are rendered again in new shards up to --retries times, then the
+status of every asset is merged in one report.
+
+Several boxes sharing a filesystem each run their part of the library with
+--node INDEX/COUNT, then their reports are merged:
+
+  python nxfarm.py merge node_0.json node_1.json --report report.json
+
+Only the standard library is used, the coordinator doesn't need Blender.
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+CLI_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nxpreview_cli.py")
+SUMMARY_PREFIX = "NXPREVIEW_SUMMARY"
+ASSETS_PREFIX = "NXPREVIEW_ASSETS"
+
+
+def asset_id(asset):
+  return f"{asset['file']}:{asset['object']}"
+
+
+def worker_command(blender, threads, cli_args):
+  command = [blender, "-b", "--factory-startup"]
+  if threads > 0:
+    command += ["-t", str(threads)]
+  return command + ["--python", CLI_SCRIPT, "--"] + cli_args
+
+
+def run_worker(command, log_path):
+  '''Run one Blender worker, return its exit code'''
+  with open(log_path, "w") as log:
+    return subprocess.run(command, stdout=log, stderr=subprocess.STDOUT).returncode
+
+
+def read_prefixed_line(log_path, prefix):
+  with open(log_path) as f:
+    for line in f:
+      if line.startswith(prefix):
+        return json.loads(line[len(prefix):])
+  return None
+
+
+def chunks(items, size):
+  return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def list_assets(args, files, workdir):
+  '''List the meshes of the .blend files, the files are shared between the workers'''
+  jobs = chunks(files, max(1, -(-len(files) // args.workers)))
+  commands = []
+  for i, job in enumerate(jobs):
+    cli_args = job + (["--assets-only"] if args.assets_only else []) + ["--list"]
+    commands.append((worker_command(args.blender, 1, cli_args),
+                     os.path.join(workdir, f"list_{i}.log")))
+
+  with ThreadPoolExecutor(max_workers=args.workers) as pool:
+    list(pool.map(lambda c: run_worker(*c), commands))
+
+  assets = []
+  for command, log_path in commands:
+    assets += read_prefixed_line(log_path, ASSETS_PREFIX) or []
+  return assets
+
+
+def node_assets(assets, node):
+  '''Keep the assets of this node, node is INDEX/COUNT'''
+  index, count = (int(n) for n in node.split("/"))
+  return [a for a in assets if zlib.crc32(asset_id(a).encode()) % count == index]
+
+
+def make_shards(assets, shard_size):
+  '''Split the assets in shards {file: [objects]}, assets of a file stay together'''
+  assets = sorted(assets, key=lambda a: (a["file"], a["object"]))
+  shards = []
+  for part in chunks(assets, shard_size):
+    shard = {}
+    for asset in part:
+      shard.setdefault(asset["file"], []).append(asset["object"])
+    shards.append(shard)
+  return shards
+
+
+def render_shards(args, shards, workdir, attempt):
+  '''Render the shards with the worker pool, return the result of each asset'''
+  commands = []
+  for i, shard in enumerate(shards):
+    name = f"shard_{attempt}_{i}"
+    shard_path = os.path.join(workdir, f"{name}.json")
+    summary_path = os.path.join(workdir, f"{name}_summary.json")
+    with open(shard_path, "w") as f:
+      json.dump(shard, f)
+    cli_args = ["--shard", shard_path, "--summary", summary_path]
+    if args.force:
+      cli_args.append("--force")
+    if len(args.profile) > 0:
+      cli_args += ["--profile", args.profile]
+    if len(args.settings) > 0:
+      cli_args += ["--settings", os.path.abspath(args.settings)]
+    if len(args.output) > 0:
+      cli_args += ["--output", os.path.abspath(args.output)]
+    commands.append((shard, summary_path,
+                     worker_command(args.blender, args.threads, cli_args),
+                     os.path.join(workdir, f"{name}.log")))
+
+  def run(job):
+    shard, summary_path, command, log_path = job
+    returncode = run_worker(command, log_path)
+    results = {}
+    if os.path.isfile(summary_path):
+      with open(summary_path) as f:
+        for result in json.load(f)["assets"]:
+          results[asset_id(result)] = result
+    # assets without result: the worker crashed or the file couldn't be opened
+    for filepath, objects in shard.items():
+      for obj in objects:
+        asset = {"file": filepath, "object": obj}
+        if asset_id(asset) not in results:
+          results[asset_id(asset)] = dict(asset, status="failed", preview="", seconds=0,
+                                          error=f"no result, worker exit code {returncode}, see {log_path}")
+    return results
+
+  results = {}
+  with ThreadPoolExecutor(max_workers=args.workers) as pool:
+    for shard_results in pool.map(run, commands):
+      results.update(shard_results)
+  return results
+
+
+def make_report(results, start):
+  assets = sorted(results.values(), key=lambda a: (a["file"], a["object"]))
+  failed = [a for a in assets if a["status"] == "failed"]
+  cached = [a for a in assets if a["status"] == "cached"]
+  return {
+    "rendered": len(assets) - len(failed) - len(cached),
+    "cached": len(cached),
+    "failed": len(failed),
+    "seconds": round(time.perf_counter() - start, 3),
+    "assets": assets
+  }
+
+
+def write_report(report, report_path):
+  if len(report_path) > 0:
+    with open(report_path, "w") as f:
+      json.dump(report, f, indent=2)
+  print(SUMMARY_PREFIX, json.dumps({k: v for k, v in report.items() if k != "assets"}))
+
+
+def run(args):
+  start = time.perf_counter()
+  workdir = args.workdir or tempfile.mkdtemp(prefix="nxfarm_")
+  os.makedirs(workdir, exist_ok=True)
+
+  files = []
+  for path in args.paths:
+    path = os.path.abspath(path)
+    if os.path.isfile(path):
+      files.append(path)
+    else:
+      for root, dirs, names in os.walk(path):
+        files += [os.path.join(root, n) for n in sorted(names) if n.endswith(".blend")]
+
+  assets = list_assets(args, files, workdir)
+  if len(args.node) > 0:
+    assets = node_assets(assets, args.node)
+  print(f"NX_Farm: {len(assets)} assets in {len(files)} files, {args.workers} workers")
+
+  results = {}
+  pending = assets
+  for attempt in range(args.retries + 1):
+    if len(pending) == 0:
+      break
+    shards = make_shards(pending, args.shard_size)
+    print(f"NX_Farm: attempt {attempt + 1}, {len(pending)} assets in {len(shards)} shards")
+    attempt_results = render_shards(args, shards, workdir, attempt)
+    for key, result in attempt_results.items():
+      result["attempts"] = attempt + 1
+      results[key] = result
+    pending = [a for a in pending if results[asset_id(a)]["status"] == "failed"]
+
+  report = make_report(results, start)
+  write_report(report, args.report)
+  return 1 if report["failed"] > 0 else 0
+
+
+def merge(args):
+  '''Merge the reports of several nodes, a rendered or cached status wins over a failed one'''
+  start = time.perf_counter()
+  results = {}
+  for report_path in args.reports:
+    with open(report_path) as f:
+      for asset in json.load(f)["assets"]:
+        key = asset_id(asset)
+        if key not in results or asset["status"] != "failed":
+          results[key] = asset
+  report = make_report(results, start)
+  write_report(report, args.report)
+  return 1 if report["failed"] > 0 else 0
+
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(prog="nxfarm", description="NX_Preview render farm")
+  commands = parser.add_subparsers(dest="command", required=True)
+
+  run_parser = commands.add_parser("run", help="render a library with several workers")
+  run_parser.add_argument("paths", nargs="+", help=".blend files or folders of .blend files")
+  run_parser.add_argument("--blender", default="blender", help="Blender executable")
+  run_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                          help="number of Blender processes at the same time")
+  run_parser.add_argument("--threads", type=int, default=0,
+                          help="render threads by worker, 0 to share the cores between workers")
+  run_parser.add_argument("--shard-size", type=int, default=25, help="assets by shard")
+  run_parser.add_argument("--retries", type=int, default=2, help="retries of failed assets")
+  run_parser.add_argument("--settings", default="", help="JSON or TOML settings file")
+  run_parser.add_argument("--output", default="", help="folder of the previews")
+  run_parser.add_argument("--assets-only", action="store_true",
+                          help="render only objects marked as asset")
+  run_parser.add_argument("--profile", default="",
+                          help="render profile: EEVEE, DRAFT, STANDARD or FINAL")
+  run_parser.add_argument("--force", action="store_true",
+                          help="render all the previews, even the ones up to date")
+  run_parser.add_argument("--node", default="", help="INDEX/COUNT, part of the library of this box")
+  run_parser.add_argument("--workdir", default="", help="folder of the shards and logs")
+  run_parser.add_argument("--report", default="", help="write the JSON report in this file")
+
+  merge_parser = commands.add_parser("merge", help="merge the reports of several boxes")
+  merge_parser.add_argument("reports", nargs="+", help="JSON reports")
+  merge_parser.add_argument("--report", default="", help="write the merged report in this file")
+
+  args = parser.parse_args(argv)
+  if args.command == "run" and args.threads == 0:
+    args.threads = max(1, (os.cpu_count() or 1) // args.workers)
+  return args
+
+
+def main(argv=None):
+  args = parse_args(sys.argv[1:] if argv is None else argv)
+  if args.command == "merge":
+    return merge(args)
+  return run(args)
+
+
+if __name__ == "__main__":
+  sys.exit(main())
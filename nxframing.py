@@ -0,0 +1,83 @@
+'''Bounds and camera framing computed with NumPy, without operator nor 3D view.
+Usable in background mode, the result only depends on the geometry'''
+import numpy as np
+
+
+def mesh_coords(mesh):
+  '''Local coordinates of the vertices as a (n, 3) array'''
+  coords = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+  mesh.vertices.foreach_get("co", coords)
+  return coords.reshape(-1, 3).astype(np.float64)
+
+
+def transform(coords, matrix):
+  '''Apply a 4x4 matrix to (n, 3) coordinates'''
+  matrix = np.array(matrix, dtype=np.float64)
+  return coords @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def object_coords(obj_eval, use_vertices=True):
+  '''World coordinates of the evaluated object: its vertices,
+  or the corners of its bound box for the objects without mesh.
+  The vertices are read from the evaluated mesh, without copy (to_mesh)'''
+  if use_vertices and obj_eval.type == 'MESH':
+    coords = mesh_coords(obj_eval.data)
+    if len(coords) > 0:
+      return transform(coords, obj_eval.matrix_world)
+  corners = np.array([tuple(corner) for corner in obj_eval.bound_box], dtype=np.float64)
+  return transform(corners, obj_eval.matrix_world)
+
+
+def extents(coords):
+  '''Size of the bounding box of the coordinates on each axis'''
+  if len(coords) == 0:
+    return np.zeros(3)
+  return coords.max(axis=0) - coords.min(axis=0)
+
+
+def normalize_scale(coords, scale, size=2):
+  '''Uniform scale giving size to the largest dimension of the object.
+  coords are local, scale is the current scale of the object'''
+  scale = np.abs(np.array(scale, dtype=np.float64))
+  local = extents(coords)
+  index = int(np.argmax(local * scale))
+  if local[index] == 0:
+    return None
+  return size / local[index]
+
+
+def fit_camera(coords, rotation, lens, sensor, aspect=1.0):
+  '''Location of a perspective camera with rotation (3x3 matrix) seeing all
+  the world coordinates, same result as Object.camera_fit_coords.
+
+  In the camera frame, each side of the frustum gives a bound on the camera
+  position. The camera is centered between the opposite sides and moved back
+  until the most constraining pair is touched.'''
+  rotation = np.array(rotation, dtype=np.float64)
+  local = coords @ rotation   # coordinates in the camera frame, the camera looks at -Z
+
+  # sensor fit AUTO: the sensor size is used by the largest side of the image
+  tan_x = sensor / 2 / lens
+  tan_y = tan_x
+  if aspect >= 1:
+    tan_y = tan_x / aspect
+  else:
+    tan_x = tan_y * aspect
+
+  x, y, z = local[:, 0], local[:, 1], local[:, 2]
+  right, left = np.max(x + tan_x * z), np.min(x - tan_x * z)
+  top, bottom = np.max(y + tan_y * z), np.min(y - tan_y * z)
+
+  center = np.array((
+    (right + left) / 2,
+    (top + bottom) / 2,
+    max((right - left) / (2 * tan_x), (top - bottom) / (2 * tan_y))
+  ))
+  return tuple(rotation @ center)
+
+
+def rotate_z(coords, angle):
+  '''Rotate (n, 3) coordinates around the Z axis of the origin, angle in radians'''
+  cos, sin = np.cos(angle), np.sin(angle)
+  rotation = np.array(((cos, -sin, 0), (sin, cos, 0), (0, 0, 1)), dtype=np.float64)
+  return coords @ rotation.T
@@ -0,0 +1,90 @@
+'''Live thumbnail of the preview in the sidebar, rendered at low resolution.
+
+A change of the settings requests a live preview, the render starts when the
+settings didn't change during DEBOUNCE seconds (bpy.app.timers). It's rendered
+coarse then finer while nothing changes. The pixels are kept by key of the
+staged object and level, settings seen before are shown without render.
+'''
+import time
+from collections import OrderedDict
+import bpy
+from . nxdata import tag_data
+from . nxpixels import set_preview_pixels
+from . nxqueue import render_queue
+
+DEBOUNCE = 0.4
+LIVE_IMAGE = "NX_LivePreview"
+MAX_CACHED = 64
+
+# resolution percentage and samples of each level, from the coarsest
+LIVE_LEVELS = (
+  {"percentage": 25, "samples": 4},
+  {"percentage": 50, "samples": 16}
+)
+
+
+class LivePreview:
+  def __init__(self):
+    self.request_time = 0.0
+    self.settings = None
+    self.level = 0
+    self.pixels = OrderedDict()
+
+  def request(self, settings):
+    '''Render the live preview with the operator settings, once they stop changing'''
+    self.settings = settings
+    self.level = 0
+    self.request_time = time.monotonic()
+    if not bpy.app.timers.is_registered(live_tick):
+      bpy.app.timers.register(live_tick, first_interval=DEBOUNCE)
+
+  def tick(self):
+    wait = self.request_time + DEBOUNCE - time.monotonic()
+    if wait > 0:
+      return wait
+    if self.settings is None or self.level >= len(LIVE_LEVELS):
+      return None
+    if render_queue.running:
+      return 1.0
+
+    try:
+      bpy.ops.object.nx_live_preview(level=self.level, **self.settings)
+    except (RuntimeError, TypeError) as e:
+      print(f"NX_Preview: live preview failed: {e}")
+      return None
+    self.level += 1
+    return 0.05 if self.level < len(LIVE_LEVELS) else None
+
+  def cached(self, key):
+    pixels = self.pixels.get(key)
+    if pixels is not None:
+      self.pixels.move_to_end(key)
+    return pixels
+
+  def store(self, key, pixels):
+    self.pixels[key] = pixels
+    while len(self.pixels) > MAX_CACHED:
+      self.pixels.popitem(last=False)
+
+  def show(self, pixels):
+    '''Put the pixels in the preview of the live image and redraw the sidebar'''
+    image = bpy.data.images.get(LIVE_IMAGE)
+    if image is None:
+      image = tag_data(bpy.data.images.new(LIVE_IMAGE, 1, 1))
+    set_preview_pixels(image, pixels)
+    for window in bpy.context.window_manager.windows:
+      for area in window.screen.areas:
+        if area.type == 'VIEW_3D':
+          area.tag_redraw()
+
+  def stop(self):
+    self.settings = None
+    if bpy.app.timers.is_registered(live_tick):
+      bpy.app.timers.unregister(live_tick)
+
+
+live_preview = LivePreview()
+
+
+def live_tick():
+  return live_preview.tick()
@@ -0,0 +1,124 @@
+'''Rendered pixels as NumPy arrays, read from the compositor and written in the ID previews'''
+import numpy as np
+import bpy
+
+VIEWER_IMAGE = "Viewer Node"
+
+
+def read_viewer_pixels():
+  '''RGBA float pixels of the last render as a (height, width, 4) array, None if no render'''
+  image = bpy.data.images.get(VIEWER_IMAGE)
+  if image is None or image.size[0] == 0 or image.size[1] == 0:
+    return None
+  width, height = image.size
+  pixels = np.empty(width * height * 4, dtype=np.float32)
+  image.pixels.foreach_get(pixels)
+  return pixels.reshape(height, width, 4)
+
+
+def alpha_over(pixels, color):
+  '''Premultiplied linear pixels over an opaque linear color, an alpha-over
+  without compositor. None keeps the transparent pixels'''
+  if color is None:
+    return pixels
+  result = np.empty_like(pixels)
+  result[..., :3] = pixels[..., :3] + (1 - pixels[..., 3:]) * np.asarray(color[:3], dtype=np.float32)
+  result[..., 3] = 1
+  return result
+
+
+def downscale(pixels, size):
+  '''Box filter the pixels by an integer factor to fit in size x size.
+  The render is premultiplied, the colors are averaged with their alpha'''
+  height, width = pixels.shape[:2]
+  factor = -(-max(width, height) // size)
+  if factor <= 1:
+    return pixels
+  height, width = height // factor, width // factor
+  pixels = pixels[:height * factor, :width * factor]
+  return pixels.reshape(height, factor, width, factor, 4).mean(axis=(1, 3))
+
+
+def linear_to_srgb(pixels):
+  '''Unpremultiply and encode the colors in sRGB, the previews store display colors'''
+  alpha = np.clip(pixels[..., 3:], 0, 1)
+  rgb = np.divide(pixels[..., :3], alpha, out=np.zeros_like(pixels[..., :3]), where=alpha > 0)
+  rgb = np.clip(rgb, 0, 1)
+  rgb = np.where(rgb <= 0.0031308, rgb * 12.92, 1.055 * np.power(rgb, 1 / 2.4) - 0.055)
+  return np.concatenate((rgb, alpha), axis=-1).astype(np.float32)
+
+
+def set_preview_pixels(id_data, pixels):
+  '''Write RGBA float pixels (height, width, 4) in the preview of the ID'''
+  height, width = pixels.shape[:2]
+  preview = id_data.preview_ensure()
+  preview.image_size = (width, height)
+  preview.image_pixels_float.foreach_set(np.ascontiguousarray(pixels, dtype=np.float32).ravel())
+
+
+def copy_preview(source, target):
+  '''Copy the preview of the source ID to the target ID, return False if there is none'''
+  pixels = read_preview(source)
+  if pixels is None:
+    return False
+  set_preview_pixels(target, pixels)
+  return True
+
+
+def sheet_shape(count):
+  '''Columns and rows of a contact sheet of count images, as square as possible'''
+  columns = int(np.ceil(np.sqrt(count)))
+  return columns, -(-count // columns)
+
+
+def new_sheet(count, size):
+  '''Transparent contact sheet for count images of size x size'''
+  columns, rows = sheet_shape(count)
+  return np.zeros((rows * size, columns * size, 4), dtype=np.float32)
+
+
+def paste_tile(sheet, pixels, index, size):
+  '''Put the image index in its cell of the sheet, from the top left.
+  The images are stored from the bottom row'''
+  columns = sheet.shape[1] // size
+  rows = sheet.shape[0] // size
+  height, width = pixels.shape[:2]
+  y = (rows - 1 - index // columns) * size
+  x = (index % columns) * size
+  sheet[y:y + height, x:x + width] = pixels
+
+
+def save_pixels(pixels, filepath):
+  '''Write display RGBA pixels (height, width, 4) in a PNG file'''
+  height, width = pixels.shape[:2]
+  image = bpy.data.images.new("NX_Pixels", width, height, alpha=True)
+  try:
+    image.pixels.foreach_set(np.ascontiguousarray(pixels, dtype=np.float32).ravel())
+    image.filepath_raw = filepath
+    image.file_format = "PNG"
+    image.save()
+  finally:
+    bpy.data.images.remove(image)
+
+
+def read_preview(id_data):
+  '''Display RGBA pixels of the preview of the ID, None if there is none'''
+  preview = id_data.preview
+  if preview is None or preview.image_size[0] == 0 or preview.image_size[1] == 0:
+    return None
+  width, height = preview.image_size
+  pixels = np.empty(width * height * 4, dtype=np.float32)
+  preview.image_pixels_float.foreach_get(pixels)
+  return pixels.reshape(height, width, 4)
+
+
+def read_image_file(filepath):
+  '''Display RGBA pixels of an image file, the image is not kept in the file'''
+  image = bpy.data.images.load(filepath, check_existing=False)
+  try:
+    width, height = image.size
+    pixels = np.empty(width * height * 4, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+  finally:
+    bpy.data.images.remove(image)
+  return pixels.reshape(height, width, 4)
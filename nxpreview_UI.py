@@ -1,5 +1,8 @@
 import bpy
 from bpy.types import Panel, PropertyGroup, UIList
+from . nxqueue import render_queue
+from . nxstats import preview_stats
+from . nxlive import LIVE_IMAGE
 
 class PREFERENCE_UL_asset_library(UIList):
    
@@ -19,6 +22,49 @@ class PREFERENCE_UL_asset_library(UIList):
       layout.label(text="", icon_value=icon)
 
 
+def set_operator_settings(op, settings):
+  '''Copy the preview settings of the scene to the operator'''
+  op.path = settings.path
+  op.mark_as_asset = settings.mark_as_asset
+  op.assign_preview = settings.assign_preview
+  op.use_backdrop = settings.use_backdrop
+  op.backdrop_style = settings.backdrop_style
+  op.use_background = settings.use_background
+  color = settings.background_color
+  op.background_color = (color.r, color.g, color.b, 1.0)
+  op.world_strength = settings.world_strength
+  op.light_top_strength = settings.light_top_strength
+  op.light_left_strength = settings.light_left_strength
+  op.light_right_strength = settings.light_right_strength
+  op.camera_focal = settings.camera_focal
+  op.camera_align_h = settings.camera_align_h
+  op.camera_align_v = settings.camera_align_v
+  op.save_in_file_folder = settings.save_in_file_folder
+  op.save_asset = settings.save_asset
+  op.library_id = settings.library_id
+  op.apply_modifier = settings.apply_modifiers
+  op.export_layout = settings.export_layout
+  op.export_file_name = settings.export_file_name
+  op.sync_library = settings.sync_library
+  op.multi_view = settings.multi_view
+  op.background_compositing = settings.background_compositing
+  op.background_variants = settings.background_variants
+  op.backdrop_variants = settings.backdrop_variants
+  op.use_relight = settings.use_relight
+  op.view_count = settings.view_count
+  op.use_cache = settings.use_cache
+  op.cache_max_size = settings.cache_max_size
+  op.cache_max_days = settings.cache_max_days
+  op.render_profile = settings.render_profile
+  op.render_threads = settings.render_threads
+  op.resolution = settings.resolution
+  op.resolution_percentage = settings.resolution_percentage
+  op.use_thumbnail_size = settings.use_thumbnail_size
+  op.save_preview_file = settings.save_preview_file
+  op.stage_mode = settings.stage_mode
+  op.stats_path = settings.stats_path
+
+
 class PreviewPanel:
   bl_space_type = 'VIEW_3D'
   bl_region_type = 'UI'
@@ -64,28 +110,43 @@ class NXPREVIEW_PT_control_panel(Panel, PreviewPanel):
   
       col.separator()      
       col = layout.column()
-      op = col.operator('object.nx_preview', text="Render Preview")
-      op.path = scene.NXPreview.path
+      row = col.row()
+      # the stage is used by the queue until it ends
+      row.enabled = not render_queue.running
+      op = row.operator('object.nx_preview', text="Render Preview")
       op.original_scene = scene.name
       op.original_object = obj.name
-      op.mark_as_asset = scene.NXPreview.mark_as_asset
-      op.assign_preview = scene.NXPreview.assign_preview
-      op.use_backdrop = scene.NXPreview.use_backdrop
-      op.backdrop_style = scene.NXPreview.backdrop_style
-      op.use_background = scene.NXPreview.use_background
-      color = scene.NXPreview.background_color
-      op.background_color = (color.r, color.g, color.b, 1.0)
-      op.world_strength = scene.NXPreview.world_strength
-      op.light_top_strength = scene.NXPreview.light_top_strength
-      op.light_left_strength = scene.NXPreview.light_left_strength
-      op.light_right_strength = scene.NXPreview.light_right_strength
-      op.camera_focal = scene.NXPreview.camera_focal
-      op.camera_align_h = scene.NXPreview.camera_align_h
-      op.camera_align_v = scene.NXPreview.camera_align_v
-      op.save_in_file_folder = scene.NXPreview.save_in_file_folder
-      op.save_asset = scene.NXPreview.save_asset
-      op.library_id = scene.NXPreview.library_id
-      op.apply_modifier = scene.NXPreview.apply_modifiers
+      set_operator_settings(op, scene.NXPreview)
+
+      col.separator()
+      col.prop(scene.NXPreview, 'batch_collection', text="")
+      if scene.NXPreview.batch_collection is not None:
+        op = col.operator('object.nx_preview_queue', text="Render Collection")
+        op.collection = scene.NXPreview.batch_collection.name
+      else:
+        op = col.operator('object.nx_preview_queue', text="Render Selected")
+      op.original_scene = scene.name
+      set_operator_settings(op, scene.NXPreview)
+      op.atlas_path = scene.NXPreview.atlas_path
+      op.atlas_size = scene.NXPreview.atlas_size
+
+      if render_queue.running:
+        box = col.box()
+        box.label(text=f"Queue {render_queue.status()}", icon="RENDER_STILL")
+        if len(render_queue.current) > 0:
+          box.label(text=render_queue.current)
+        row = box.row(align=True)
+        row.operator('object.nx_queue_pause', text="Resume" if render_queue.paused else "Pause",
+                     icon="PLAY" if render_queue.paused else "PAUSE")
+        row.operator('object.nx_queue_cancel', text="Cancel", icon="CANCEL")
+
+      col.separator()
+      row = col.row(align=True)
+      if "NXPreviewScene" in bpy.data.scenes and not render_queue.running:
+        row.operator('object.nx_stage_clear', text="Clear Preview Stage", icon="TRASH")
+      row.operator('object.nx_purge_orphans', text="" if "NXPreviewScene" in bpy.data.scenes else "Purge Orphan Data", 
+                   icon="ORPHAN_DATA")
+      row.operator('object.nx_resources_reload', text="", icon="FILE_REFRESH")
 
 
 class NXPREVIEW_PT_Background(Panel, PreviewPanel):
@@ -106,6 +167,7 @@ class NXPREVIEW_PT_Background(Panel, PreviewPanel):
       layout.use_property_split = True
       col = layout.column()  
       col.prop(scene.NXPreview, 'backdrop_style', text="Style")
+      col.prop(scene.NXPreview, 'backdrop_variants', text="Style Variants")
     
     layout.use_property_split = False
     col = layout.column()
@@ -114,6 +176,11 @@ class NXPREVIEW_PT_Background(Panel, PreviewPanel):
       layout.use_property_split = True
       col = layout.column()
       col.prop(scene.NXPreview, 'background_color', text="Color")
+      col.prop(scene.NXPreview, 'background_compositing', text="Compositing")
+
+    layout.use_property_split = False
+    col = layout.column()
+    col.prop(scene.NXPreview, 'background_variants', text="Background Variants")
 
 
 class NXPREVIEW_PT_Lighting(Panel, PreviewPanel):
@@ -133,6 +200,11 @@ class NXPREVIEW_PT_Lighting(Panel, PreviewPanel):
     col.prop(scene.NXPreview, "light_left_strength", text="Left")
     col.prop(scene.NXPreview, "light_right_strength", text="Right")
 
+    layout.use_property_split = False
+    row = layout.row(align=True)
+    row.prop(scene.NXPreview, "use_relight", text="Relight Passes")
+    row.operator('object.nx_relight', text="", icon="LIGHT")
+
 
 class NXPREVIEW_PT_Camera(Panel, PreviewPanel):
   bl_label = "Camera"
@@ -156,6 +228,47 @@ class NXPREVIEW_PT_Camera(Panel, PreviewPanel):
     row = col.row(align=True)
     row.prop(scene.NXPreview, "camera_align_v", text="V", expand=True)
 
+    layout.use_property_split = False
+    row = layout.row(align=True)
+    row.prop(scene.NXPreview, "use_live_preview", text="Live Preview")
+    if context.object is not None and context.object.type == 'MESH':
+      op = row.operator('object.nx_live_preview', text="", icon="FILE_REFRESH")
+      op.original_scene = scene.name
+      op.original_object = context.object.name
+      set_operator_settings(op, scene.NXPreview)
+    image = bpy.data.images.get(LIVE_IMAGE)
+    if scene.NXPreview.use_live_preview and image is not None and image.preview is not None:
+      layout.template_icon(icon_value=image.preview.icon_id, scale=8)
+    layout.use_property_split = True
+    col = layout.column()
+    col.prop(scene.NXPreview, "multi_view", text="Multi-View")
+    if scene.NXPreview.multi_view != 'NONE':
+      col.prop(scene.NXPreview, "view_count", text="Views")
+
+
+class NXPREVIEW_PT_Render(Panel, PreviewPanel):
+  bl_label = "Render"
+  bl_parent_id = "NXPREVIEW_PT_control_panel"
+  bl_options = {"DEFAULT_CLOSED"}
+
+  def draw(self, context):
+    scene = context.scene
+    layout = self.layout
+    layout.use_property_split = True
+    layout.use_property_decorate = False
+
+    col = layout.column()
+    col.prop(scene.NXPreview, "render_profile", text="Profile")
+    col.prop(scene.NXPreview, "render_threads", text="Threads")
+    col.prop(scene.NXPreview, "stage_mode", text="Staging")
+
+    col = layout.column()
+    col.prop(scene.NXPreview, "use_thumbnail_size")
+    sub = col.column(align=True)
+    sub.enabled = not scene.NXPreview.use_thumbnail_size
+    sub.prop(scene.NXPreview, "resolution")
+    sub.prop(scene.NXPreview, "resolution_percentage", text="%")
+
 
 class NXPREVIEW_PT_Output(Panel, PreviewPanel):
   bl_label = "Output"
@@ -170,6 +283,17 @@ class NXPREVIEW_PT_Output(Panel, PreviewPanel):
     layout.use_property_decorate = False
 
     col = layout.column()
+    col.label(text="Atlas of the Batch")
+    row = col.row(align=True)
+    row.prop(scene.NXPreview, "atlas_path", text="")
+    row.prop(scene.NXPreview, "atlas_size", text="")
+    col.separator()
+    col.prop(scene.NXPreview, "save_preview_file", text="Save Preview File")
+    if not scene.NXPreview.save_preview_file:
+      col.prop(scene.NXPreview, "use_cache", text="Use Cache")
+      return
+
+    col.separator()
     col.label(text="Preview Output")
 
     if bpy.data.is_saved:
@@ -179,6 +303,62 @@ class NXPREVIEW_PT_Output(Panel, PreviewPanel):
       col.label(text="Select Folder")
       col.prop(scene.NXPreview, "path", text="")
 
+    col.separator()
+    col.prop(scene.NXPreview, "use_cache", text="Use Cache")
+
+    if not scene.NXPreview.save_in_file_folder and len(scene.NXPreview.path) == 0:
+      layout.use_property_split = True
+      col = layout.column(align=True)
+      col.prop(scene.NXPreview, "cache_max_size", text="Cache Size (MB)")
+      col.prop(scene.NXPreview, "cache_max_days", text="Days")
+      row = layout.row(align=True)
+      op = row.operator('object.nx_cache_clean', text="Clean Cache")
+      op.max_size = scene.NXPreview.cache_max_size
+      op.max_days = scene.NXPreview.cache_max_days
+      op = row.operator('object.nx_cache_clean', text="", icon="TRASH")
+      op.clear_all = True
+
+
+class NXPREVIEW_PT_Stats(Panel, PreviewPanel):
+  bl_label = "Statistics"
+  bl_parent_id = "NXPREVIEW_PT_control_panel"
+  bl_options = {"DEFAULT_CLOSED"}
+
+  def draw(self, context):
+    scene = context.scene
+    layout = self.layout
+    layout.use_property_split = False
+    layout.use_property_decorate = False
+
+    col = layout.column()
+    col.label(text="Log File (JSON or CSV)")
+    col.prop(scene.NXPreview, "stats_path", text="")
+
+    summary = preview_stats.summary
+    if summary is None:
+      col.label(text="No preview rendered")
+      return
+
+    col.separator()
+    col.label(text=f"{summary['assets']} assets in {summary['seconds']:.2f}s, {summary['mean']:.2f}s/asset")
+    if summary["peak_memory_mb"] > 0:
+      col.label(text=f"Peak memory {summary['peak_memory_mb']:.0f} MB")
+
+    box = col.box()
+    box.label(text="Stages")
+    for name, seconds in list(summary["stages"].items())[:6]:
+      row = box.row()
+      row.label(text=name)
+      row.label(text=f"{seconds:.3f}s")
+
+    if summary["assets"] > 1:
+      box = col.box()
+      box.label(text="Slowest")
+      for name, seconds in summary["slowest"]:
+        row = box.row()
+        row.label(text=name)
+        row.label(text=f"{seconds:.2f}s")
+
 
 class NXPREVIEW_PT_SaveAsset(Panel, PreviewPanel):
   bl_label = "Save Asset"
@@ -207,6 +387,11 @@ class NXPREVIEW_PT_SaveAsset(Panel, PreviewPanel):
 
     col = layout.column()
     col.prop(scene.NXPreview, 'apply_modifiers', text="Apply Modifiers")
+    col.label(text="Batch Layout")
+    col.prop(scene.NXPreview, 'export_layout', text="")
+    if scene.NXPreview.export_layout == 'SINGLE':
+      col.prop(scene.NXPreview, 'export_file_name', text="File")
+    col.prop(scene.NXPreview, 'sync_library', text="Sync Library")
     row = layout.row(align=False)
 
     fp = context.preferences.filepaths
@@ -223,3 +408,22 @@ class NXPREVIEW_PT_SaveAsset(Panel, PreviewPanel):
     col = row.column(align=True)
     col.operator('asset.nx_library_add', text="", icon="ADD")
     op = col.operator('asset.nx_library_remove', text="", icon="REMOVE")
+
+    op = layout.operator('asset.nx_asset_export', text="Export Selected Assets")
+    op.layout = scene.NXPreview.export_layout
+    op.file_name = scene.NXPreview.export_file_name
+    op.library_id = scene.NXPreview.library_id
+    op.apply_modifiers = scene.NXPreview.apply_modifiers
+    op.assign_preview = scene.NXPreview.assign_preview
+
+    row = layout.row(align=True)
+    for remove_stale in (False, True):
+      op = row.operator('asset.nx_library_sync', 
+                        text="" if remove_stale else "Sync Library", 
+                        icon="TRASH" if remove_stale else "FILE_REFRESH")
+      op.remove_stale = remove_stale
+      op.layout = scene.NXPreview.export_layout
+      op.file_name = scene.NXPreview.export_file_name
+      op.library_id = scene.NXPreview.library_id
+      op.apply_modifiers = scene.NXPreview.apply_modifiers
+      op.assign_preview = scene.NXPreview.assign_preview
@@ -0,0 +1,239 @@
+'''Render previews from the command line, without the UI.
+
+  blender -b --factory-startup --python nxpreview_cli.py -- [options] PATH [PATH ...]
+
+PATH is a .blend file or a folder of .blend files. The settings file (JSON,
+or TOML with Python 3.11+) uses the names of the operator properties, eg:
+
+  {"use_backdrop": true, "backdrop_style": "LIGHT", "camera_focal": 85}
+
+A summary is written to --summary (and printed on a NXPREVIEW_SUMMARY line),
+the exit code is 1 if a preview failed.
+
+--list only prints the meshes found on a NXPREVIEW_ASSETS line and --shard
+renders the objects listed in a JSON file {"file.blend": ["object", ...]},
+both are used by the render farm coordinator (nxfarm.py).
+'''
+import argparse
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+import zlib
+import bpy
+
+SUMMARY_PREFIX = "NXPREVIEW_SUMMARY"
+ASSETS_PREFIX = "NXPREVIEW_ASSETS"
+BACKDROP_STYLES = ("NEUTRAL", "LIGHT", "DARK")
+
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(
+    prog="nxpreview_cli",
+    description="Render NX_Preview previews of every mesh of .blend files"
+  )
+  parser.add_argument("paths", nargs="*",
+                      help=".blend files or folders of .blend files")
+  parser.add_argument("--settings", default="",
+                      help="JSON or TOML file with the preview settings")
+  parser.add_argument("--output", default="",
+                      help="folder of the previews, a sub folder by .blend file, override the path setting")
+  parser.add_argument("--assets-only", action="store_true",
+                      help="render only objects marked as asset")
+  parser.add_argument("--recursive", action="store_true",
+                      help="search .blend files in sub folders")
+  parser.add_argument("--profile", default="",
+                      help="render profile: EEVEE, DRAFT, STANDARD or FINAL")
+  parser.add_argument("--force", action="store_true",
+                      help="render all the previews, even the ones up to date")
+  parser.add_argument("--save", action="store_true",
+                      help="save the .blend files to keep the assigned previews")
+  parser.add_argument("--summary", default="",
+                      help="write the JSON summary in this file")
+  parser.add_argument("--list", action="store_true",
+                      help="print the meshes to render and exit")
+  parser.add_argument("--shard", default="",
+                      help="JSON file of the objects to render by .blend file")
+  return parser.parse_args(argv)
+
+
+def load_settings(filepath):
+  if len(filepath) == 0:
+    return {}
+  if filepath.lower().endswith(".toml"):
+    import tomllib
+    with open(filepath, "rb") as f:
+      return tomllib.load(f)
+  with open(filepath) as f:
+    return json.load(f)
+
+
+def find_blend_files(paths, recursive=False):
+  files = []
+  for path in paths:
+    path = os.path.abspath(path)
+    if os.path.isfile(path):
+      files.append(path)
+    elif recursive:
+      for root, dirs, names in os.walk(path):
+        files += [os.path.join(root, n) for n in sorted(names) if n.endswith(".blend")]
+    else:
+      files += [os.path.join(path, n) for n in sorted(os.listdir(path)) if n.endswith(".blend")]
+  return files
+
+
+def ensure_addon():
+  '''Register the addon if it's not enabled in this Blender session'''
+  if hasattr(bpy.types.Scene, "NXPreview"):
+    return
+  addon_dir = os.path.dirname(os.path.abspath(__file__))
+  if os.path.dirname(addon_dir) not in sys.path:
+    sys.path.insert(0, os.path.dirname(addon_dir))
+  addon = importlib.import_module(os.path.basename(addon_dir))
+  addon.register()
+
+
+def operator_settings(settings):
+  '''Keep only the settings known by the batch operator'''
+  known = bpy.ops.object.nx_preview_batch.get_rna_type().properties.keys()
+  for key in settings:
+    if key not in known:
+      print(f"NX_Preview: unknown setting '{key}' ignored")
+  settings = {k: v for k, v in settings.items() if k in known and k != "objects"}
+  if "backdrop_style" in settings:
+    style = str(settings["backdrop_style"]).upper()
+    if style not in BACKDROP_STYLES:
+      print(f"NX_Preview: unknown backdrop_style '{settings['backdrop_style']}', NEUTRAL used")
+      style = "NEUTRAL"
+    settings["backdrop_style"] = style
+  return settings
+
+
+def get_mesh_names(assets_only=False):
+  return [obj.name for obj in bpy.data.objects
+            if obj.type == "MESH" and obj.library is None and
+               (not assets_only or obj.asset_data is not None)]
+
+
+def list_assets(files, assets_only=False):
+  assets = []
+  for filepath in files:
+    if bpy.data.filepath != filepath:
+      bpy.ops.wm.open_mainfile(filepath=filepath)
+    assets += [{"file": filepath, "object": name} for name in get_mesh_names(assets_only)]
+  print(ASSETS_PREFIX, json.dumps(assets))
+  return assets
+
+
+def file_output_dir(output, filepath):
+  '''Folder of the previews of a .blend file in output, objects of the same
+  name in other files don't share a preview. Named by the file and a hash of
+  its path, the same for every worker of the farm'''
+  filepath = os.path.abspath(filepath)
+  stem = os.path.splitext(os.path.basename(filepath))[0]
+  return os.path.join(output, f"{stem}_{zlib.crc32(filepath.encode()):08x}")
+
+
+def render_file(filepath, settings, object_names=None, assets_only=False, save=False, output=""):
+  '''Render the previews of one .blend file, return the result of each object.
+  With output, the previews are written in the folder of the file in output'''
+  if len(output) > 0:
+    settings = dict(settings, path=file_output_dir(output, filepath))
+    os.makedirs(settings["path"], exist_ok=True)
+  if bpy.data.filepath != filepath:
+    bpy.ops.wm.open_mainfile(filepath=filepath)
+
+  if object_names is None:
+    object_names = get_mesh_names(assets_only)
+  if len(object_names) == 0:
+    return []
+
+  fd, report_path = tempfile.mkstemp(prefix="nxpreview_", suffix=".json")
+  os.close(fd)
+  try:
+    bpy.ops.object.nx_preview_batch(
+      objects=[{"name": name} for name in object_names],
+      report_path=report_path,
+      **settings
+    )
+    with open(report_path) as f:
+      results = json.load(f)
+  finally:
+    os.remove(report_path)
+
+  if save:
+    # the stage is kept between renders, it must not be saved in the library
+    if bpy.ops.object.nx_stage_clear.poll():
+      bpy.ops.object.nx_stage_clear()
+    bpy.ops.wm.save_mainfile()
+
+  for result in results:
+    result["file"] = filepath
+    result["output"] = settings.get("path", "")
+  return results
+
+
+def write_summary(results, start, summary_path=""):
+  failed = [r for r in results if r["status"] == "failed"]
+  cached = [r for r in results if r["status"] == "cached"]
+  summary = {
+    "files": len({r["file"] for r in results}),
+    "rendered": len(results) - len(failed) - len(cached),
+    "cached": len(cached),
+    "failed": len(failed),
+    "seconds": round(time.perf_counter() - start, 3),
+    "assets": results
+  }
+  if len(summary_path) > 0:
+    with open(summary_path, "w") as f:
+      json.dump(summary, f, indent=2)
+  print(SUMMARY_PREFIX, json.dumps({k: v for k, v in summary.items() if k != "assets"}))
+  return summary
+
+
+def main(argv=None):
+  if argv is None:
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+  args = parse_args(argv)
+  start = time.perf_counter()
+
+  files = find_blend_files(args.paths, args.recursive)
+  if args.list:
+    list_assets(files, args.assets_only)
+    return 0
+
+  shard = {filepath: None for filepath in files}
+  if len(args.shard) > 0:
+    with open(args.shard) as f:
+      shard = json.load(f)
+
+  ensure_addon()
+  settings = operator_settings(load_settings(args.settings))
+  output = ""
+  if len(args.output) > 0:
+    output = os.path.abspath(args.output)
+    os.makedirs(output, exist_ok=True)
+    settings["save_in_file_folder"] = False
+  if args.force:
+    settings["use_cache"] = False
+  if len(args.profile) > 0:
+    settings["render_profile"] = args.profile.upper()
+
+  results = []
+  for filepath, object_names in shard.items():
+    try:
+      results += render_file(filepath, settings, object_names=object_names,
+                             assets_only=args.assets_only, save=args.save, output=output)
+    except Exception as e:
+      results.append({"file": filepath, "object": "", "status": "failed",
+                      "preview": "", "output": file_output_dir(output, filepath) if output else "",
+                      "seconds": 0, "error": str(e)})
+
+  summary = write_summary(results, start, args.summary)
+  return 1 if summary["failed"] > 0 else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
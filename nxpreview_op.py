@@ -1,9 +1,21 @@
 import os
+import json
+import time
 from math import radians
 import bpy
-from bpy.props import StringProperty, BoolProperty
-from bpy.types import Operator
+from bpy.props import StringProperty, BoolProperty, IntProperty, CollectionProperty
+from bpy.types import Operator, PropertyGroup
 from . nxbase_op import NXBase
+from . nxcache import PreviewCache, managed_cache_dir
+from . nxqueue import render_queue
+from . nxdata import purge_orphan_data
+from . nxstats import preview_stats
+from . nxresources import reload_resources
+from . nxatlas import AtlasBuilder
+from . nxpixels import (read_preview, read_image_file, read_viewer_pixels, downscale, 
+                        alpha_over, linear_to_srgb)
+from . nxrelight import relight_preview
+from . nxlive import live_preview, LIVE_LEVELS
 
 class OBJECT_OT_NXPreview(Operator, NXBase):
   bl_idname = "object.nx_preview"
@@ -11,34 +23,20 @@ class OBJECT_OT_NXPreview(Operator, NXBase):
   bl_options = {"INTERNAL"}
 
   def after_render_preview(self, scene, depsgraph):
-    obj = bpy.data.objects[self.original_object]
-    if self.mark_as_asset or obj.asset_data is not None:
-      obj.asset_mark()
-    
-      if self.assign_preview:
-        bpy.ops.ed.lib_id_load_custom_preview(
-          {"id":obj}, 
-          filepath=f"{self.preview_filepath}.{self.file_format['ext']}"
-        )
-      else:
-        obj.asset_generate_preview()
+    filepath = f"{self.preview_filepath}.{self.file_format['ext']}"
+    if not self.save_preview_file:
+      # the preview has been set from the rendered pixels
+      filepath = ""
+    self.assign_asset_preview(self.original_object, filepath)
     
     scene.render.use_lock_interface = False
-    self.purge_scene(self.scene_preview)
-    bpy.data.scenes.remove(bpy.data.scenes[self.scene_preview], do_unlink=True)
-    self.purge_orphan_data()
+    self.remove_preview_object(scene)
 
     print("=====Preview rendered=====")
 
-    bpy.ops.asset.nx_asset_save(
-                                save_asset=self.save_asset,
-                                filepath=f"{self.preview_filepath}.{self.file_format['ext']}",
-                                assign_preview=self.assign_preview,
-                                library_id=self.library_id,
-                                original_scene=self.original_scene,
-                                original_object=self.original_object,
-                                apply_modifiers=self.apply_modifier
-                              )
+    self.save_asset_in_library(self.original_object, filepath)
+    # the asset file is copied in the background, failures of the previous ones
+    self.report_write_failures()
     # if self.save_asset:
     #   libraries = bpy.context.preferences.filepaths.asset_libraries
     #   if (self.library_id >= 0 and 
@@ -95,42 +93,556 @@ class OBJECT_OT_NXPreview(Operator, NXBase):
     #     print('LIB NOT EXIST')
 
     self.report({'INFO'}, "Preview rendered")
-    
-    bpy.app.handlers.render_post.remove(self.after_render_preview)
   
   def execute(self, context):
     scene = context.scene
     self.original_scene = scene.name
-    obj = context.object
-    self.original_object = obj.name
+    object_name = context.object.name
 
-    self.create_scene_and_switch_to(context, self.scene_preview)
+    preview_stats.begin_run()
+    self.build_stage(context)
+    stage = self.get_stage()
 
-    self.copy_object(context)
+    preview_stats.begin_asset(object_name)
+    self.stage_object(stage, object_name)
 
-    self.add_cam(context)
+    key = self.get_cache_key(stage)
+    self.preview_key = key
+    cache = None
+    if not self.save_preview_file:
+      rendered = not (self.use_cache and self.preview_up_to_date(object_name, key))
+      if rendered:
+        self.render_preview(stage)
+        # read before the views replace the pixels of the viewer
+        self.set_rendered_preview(object_name, key)
+    else:
+      cache = PreviewCache(self.get_preview_dir())
+      filepath = self.set_preview_filepath()
+      rendered = not (self.use_cache and cache.lookup(key, filepath))
+      if rendered:
+        render_start = time.perf_counter()
+        self.render_preview(stage)    
+        cache.add(key, filepath, time.perf_counter() - render_start)
 
-    self.add_light(context, "Area_1", loc=(0,-1,3), rot=(18.7,0,0), size=2, 
-                    energy=self.light_top_strength, energy_max=75)
-    self.add_light(context, "Area_2", loc=(-2,-3,3), rot=(34.2,0,-58.6), size=0.25, 
-                    energy=self.light_left_strength, energy_max=150)
-    self.add_light(context, "Area_3", loc=(4,0,1), rot=(0,75,0), size=0.25, 
-                    energy=self.light_right_strength, energy_max=100)
+    self.write_background_variants(stage, cache, key, rendered)
+    self.write_backdrop_variants(stage, cache, key, rendered)
+    self.store_light_passes(stage, cache, key, rendered)
+    self.render_views(stage, cache, key)
 
-    self.add_world(context)
+    if not rendered:
+      print("=====Preview up to date=====")
+    # the render is blocking, the preview is ready
+    self.after_render_preview(stage, None)
+    preview_stats.end_asset("rendered" if rendered else "cached")
+    if cache is not None:
+      # after the assignment, the limits could remove the new preview file
+      self.evict_cache(cache)
+      cache.save()
 
-    if self.use_backdrop:
-      self.add_backdrop(context)
-    
-    if self.use_background:
-      self.add_background(context)
+    if context.window is not None:
+      context.window.scene = scene    
+    preview_stats.end_run(self.stats_path)
+
+    return {'FINISHED'}
+
+
+class OBJECT_OT_NXLivePreview(Operator, NXBase):
+  bl_idname = "object.nx_live_preview"
+  bl_label = "Live Preview"
+  bl_description = "Render the live thumbnail of the preview at low resolution"
+  bl_options = {"INTERNAL"}
+
+  level : IntProperty(
+    default=len(LIVE_LEVELS) - 1,
+    min=0,
+    max=len(LIVE_LEVELS) - 1
+  )
+
+  @classmethod
+  def poll(cls, context):
+    # also called by the timer of the live preview, without object in the context
+    return not render_queue.running
+
+  def render_live(self, scene):
+    '''Render the stage with the resolution and samples of the level'''
+    level = LIVE_LEVELS[self.level]
+    render = scene.render
+    percentage = render.resolution_percentage
+    samples = scene.cycles.samples if render.engine == 'CYCLES' else scene.eevee.taa_render_samples
+
+    render.resolution_percentage = level["percentage"]
+    if render.engine == 'CYCLES':
+      scene.cycles.samples = min(samples, level["samples"])
+    else:
+      scene.eevee.taa_render_samples = min(samples, level["samples"])
+    self.set_render_output(scene)
+    # the live renders don't write files
+    self.mute_file_outputs(scene)
+    try:
+      with preview_stats.stage("live"):
+        bpy.ops.render.render(scene=scene.name)
+    finally:
+      render.resolution_percentage = percentage
+      if render.engine == 'CYCLES':
+        scene.cycles.samples = samples
+      else:
+        scene.eevee.taa_render_samples = samples
+      self.mute_file_outputs(scene, False)
+
+    pixels = alpha_over(read_viewer_pixels(), self.view_background())
+    return linear_to_srgb(downscale(pixels, self.thumbnail_size // 2))
+
+  def execute(self, context):
+    if self.original_object not in bpy.data.objects:
+      return {'CANCELLED'}
+
+    self.build_stage(context)
+    stage = self.get_stage()
+    self.add_viewer(stage)
+    self.stage_object(stage, self.original_object)
+
+    key = f"{self.get_cache_key(stage)}:{self.level}"
+    pixels = live_preview.cached(key)
+    if pixels is None:
+      pixels = self.render_live(stage)
+      live_preview.store(key, pixels)
+    live_preview.show(pixels)
+
+    self.remove_preview_object(stage)
+    if context.window is not None and self.original_scene in bpy.data.scenes:
+      context.window.scene = bpy.data.scenes[self.original_scene]
+    return {'FINISHED'}
+
+
+class NXBatch(NXBase):
+  '''Objects to render and results, shared by the batch and the queue operators'''
+  objects : CollectionProperty(
+    type=PropertyGroup
+  )
+  collection : StringProperty(
+    default=""
+  )
+  report_path : StringProperty(
+    description="Write the result of each render in this JSON file",
+    default="",
+    subtype="FILE_PATH"
+  )
+  atlas_path : StringProperty(
+    default="",
+    subtype="DIR_PATH"
+  )
+  atlas_size : IntProperty(
+    default=2048,
+    min=256,
+    max=16384
+  )
+
+  @classmethod
+  def poll(cls, context):
+    return context.mode == 'OBJECT' and not render_queue.running
+
+  def get_object_names(self, context):
+    '''Objects to render: objects list, else collection, else selection'''
+    if len(self.objects) > 0:
+      objs = [bpy.data.objects.get(item.name) for item in self.objects]
+    elif len(self.collection) > 0:
+      objs = bpy.data.collections[self.collection].all_objects
+    else:
+      objs = context.selected_objects
+    return [obj.name for obj in objs if obj is not None and obj.type == "MESH"]
+
+  def lookup_preview(self, cache, object_name, key):
+    '''Return True if the preview of the staged object is up to date'''
+    if not self.use_cache:
+      return False
+    if not self.save_preview_file:
+      return self.preview_up_to_date(object_name, key)
+    return cache.lookup(key, self.set_preview_filepath())
+
+  def store_preview(self, cache, object_name, key, render_time):
+    '''Keep the preview of the last render'''
+    if not self.save_preview_file:
+      self.set_rendered_preview(object_name, key)
+    else:
+      cache.add(key, self.get_preview_path(), render_time)
+
+  def begin_atlas(self):
+    self.atlas = None
+    if len(self.atlas_path) > 0:
+      self.atlas = AtlasBuilder(bpy.path.abspath(self.atlas_path), sheet_size=self.atlas_size, 
+                                tile_size=self.thumbnail_size)
+
+  def add_to_atlas(self, object_name, filepath):
+    '''Stream the preview in the atlas, from its file or from the object'''
+    if self.atlas is None:
+      return
+    with preview_stats.stage("atlas"):
+      if os.path.isfile(filepath):
+        pixels = read_image_file(filepath)
+      else:
+        pixels = read_preview(bpy.data.objects[object_name])
+      if pixels is not None:
+        self.atlas.add(object_name, pixels)
 
-    self.render_preview(context)    
-    context.window.scene = scene    
+  def get_preview_path(self):
+    if not self.save_preview_file:
+      return ""
+    return f"{self.preview_filepath}.{self.file_format['ext']}"
 
+  def finish_batch(self, context, stage, cache, results, start):
+    '''Restore the scene, assign the previews, save the assets and report'''
+    stage.render.use_lock_interface = False
+    self.remove_preview_object(stage)
+    if context.window is not None:
+      context.window.scene = bpy.data.scenes[self.original_scene]
+
+    rendered = [r for r in results if r["status"] != "failed"]
+    assets = [r for r in rendered if r["object"] in bpy.data.objects]
+    for result in assets:
+      self.assign_asset_preview(result["object"], result["preview"])
+    self.export_assets_in_library([result["object"] for result in assets])
+    # the batch is done when the files are in the library
+    with preview_stats.stage("library_flush"):
+      self.report_write_failures(wait=True)
+
+    if self.save_preview_file:
+      self.evict_cache(cache)
+      cache.save()
+
+    if self.atlas is not None:
+      manifest_path = self.atlas.close()
+      print(f"NX_Preview: {len(self.atlas.assets)} previews in {len(self.atlas.sheets)} sheets, {manifest_path}")
+
+    if len(self.report_path) > 0:
+      with open(bpy.path.abspath(self.report_path), "w") as f:
+        json.dump(results, f, indent=2)
+    preview_stats.end_run(self.stats_path)
+
+    self.report({'INFO'} if len(rendered) == len(results) else {'WARNING'}, 
+                f"{len(rendered)}/{len(results)} previews rendered in {time.perf_counter() - start:.2f}s")
+
+
+class OBJECT_OT_NXPreviewBatch(Operator, NXBatch):
+  bl_idname = "object.nx_preview_batch"
+  bl_label = "Render Previews"
+  bl_description = "Render previews of the selected meshes or of a collection in one pass"
+  bl_options = {"INTERNAL"}
+
+  def execute(self, context):
+    scene = context.scene
+    self.original_scene = scene.name
+    object_names = self.get_object_names(context)
+
+    if len(object_names) == 0:
+      self.report({'WARNING'}, "No mesh to render")
+      return {'CANCELLED'}
+
+    wm = context.window_manager
+    wm.progress_begin(0, len(object_names))
+    start = time.perf_counter()
+
+    preview_stats.begin_run()
+    self.build_stage(context)
+    stage = self.get_stage()
+    cache = PreviewCache(self.get_preview_dir())
+    self.begin_atlas()
+
+    results = []
+    for i, object_name in enumerate(object_names):
+      item_start = time.perf_counter()
+      result = {"object": object_name, "status": "rendered", "preview": "", "error": ""}
+      preview_stats.begin_asset(object_name)
+
+      try:
+        self.stage_object(stage, object_name)
+        key = self.get_cache_key(stage)
+        if self.lookup_preview(cache, object_name, key):
+          result["status"] = "cached"
+        else:
+          render_start = time.perf_counter()
+          self.render_preview(stage)
+          self.store_preview(cache, object_name, key, time.perf_counter() - render_start)
+        result["preview"] = self.get_preview_path()
+        result["backgrounds"] = self.write_background_variants(stage, cache, key, 
+                                                               result["status"] == "rendered")
+        result["backdrops"] = self.write_backdrop_variants(stage, cache, key, 
+                                                           result["status"] == "rendered")
+        self.store_light_passes(stage, cache, key, result["status"] == "rendered")
+        result["views"] = self.render_views(stage, cache, key)
+        self.add_to_atlas(object_name, result["preview"])
+      except Exception as e:
+        result["status"] = "failed"
+        result["error"] = str(e)
+
+      result["seconds"] = round(time.perf_counter() - item_start, 3)
+      results.append(result)
+      preview_stats.end_asset(result["status"])
+
+      wm.progress_update(i + 1)
+      print(f"[{i + 1}/{len(object_names)}] {object_name}: {result['status']} {result['seconds']:.2f}s")
+
+    self.finish_batch(context, stage, cache, results, start)
+    wm.progress_end()
     return {'FINISHED'}
 
+
+class OBJECT_OT_NXPreviewQueue(Operator, NXBatch):
+  bl_idname = "object.nx_preview_queue"
+  bl_label = "Render Previews"
+  bl_description = "Render previews one by one without locking the interface.\nObjects are added to the queue if it's running"
+  bl_options = {"INTERNAL"}
+
+  @classmethod
+  def poll(cls, context):
+    # objects are added to the queue while it's running
+    return context.mode == 'OBJECT'
+
   def invoke(self, context, event):
-    if self.after_render_preview not in bpy.app.handlers.render_post:
-       bpy.app.handlers.render_post.append(self.after_render_preview)
-    return self.execute(context)
+    object_names = self.get_object_names(context)
+    if len(object_names) == 0:
+      self.report({'WARNING'}, "No mesh to render")
+      return {'CANCELLED'}
+
+    if render_queue.running:
+      added = render_queue.extend(object_names)
+      self.report({'INFO'}, f"{added} previews added to the queue")
+      return {'FINISHED'}
+
+    scene = context.scene
+    self.original_scene = scene.name
+    self.build_stage(context)
+    context.window.scene = scene
+    self.cache = PreviewCache(self.get_preview_dir())
+    self.results = []
+    self.item = None
+    self.begin_atlas()
+    render_queue.begin(object_names, self.scene_preview)
+    preview_stats.begin_run()
+
+    # keep the interface, the render window would take the focus for each preview
+    view = context.preferences.view
+    self.render_display_type = view.render_display_type
+    view.render_display_type = 'NONE'
+
+    wm = context.window_manager
+    self._timer = wm.event_timer_add(0.1, window=context.window)
+    wm.modal_handler_add(self)
+    return {'RUNNING_MODAL'}
+
+  def modal(self, context, event):
+    if event.type != 'TIMER':
+      return {'PASS_THROUGH'}
+
+    if render_queue.state == "RENDERING":
+      return {'PASS_THROUGH'}
+    if render_queue.state == "COMPLETE":
+      self.end_item()
+    elif render_queue.state == "CANCELLED":
+      self.end_item("Render cancelled")
+      render_queue.cancel_requested = True
+
+    if render_queue.cancel_requested or len(render_queue.pending) == 0:
+      return self.finish(context)
+    if render_queue.paused:
+      return {'PASS_THROUGH'}
+
+    self.start_item(render_queue.next())
+    self.redraw(context)
+    return {'PASS_THROUGH'}
+
+  def start_item(self, object_name):
+    '''Stage the object and start its render, or end it if the preview is up to date'''
+    stage = self.get_stage()
+    self.item = {"object": object_name, "status": "rendered", "preview": "", "error": "", 
+                 "key": "", "start": time.perf_counter()}
+    preview_stats.begin_asset(object_name)
+    try:
+      if object_name not in bpy.data.objects:
+        raise KeyError(f"Object '{object_name}' not found")
+      self.stage_object(stage, object_name)
+      self.item["key"] = self.get_cache_key(stage)
+      if self.lookup_preview(self.cache, object_name, self.item["key"]):
+        self.item["status"] = "cached"
+        self.end_item()
+        return
+      render_queue.state = "RENDERING"
+      self.item["render_start"] = time.perf_counter()
+      self.render_preview(stage, invoke=True)
+    except Exception as e:
+      self.end_item(str(e))
+
+  def end_item(self, error=""):
+    item = self.item
+    render_queue.state = "IDLE"
+    if "render_start" in item:
+      # the render job also writes the file
+      preview_stats.add_stage("render", time.perf_counter() - item.pop("render_start"))
+    try:
+      if len(error) == 0 and item["status"] == "rendered":
+        if self.save_preview_file and self.numpy_background():
+          self.write_preview_file(self.get_stage())
+        self.store_preview(self.cache, item["object"], item["key"], 
+                           time.perf_counter() - item["start"])
+      item["preview"] = self.get_preview_path()
+      if len(error) == 0:
+        # blocking, the object is still staged
+        item["backgrounds"] = self.write_background_variants(self.get_stage(), self.cache, item["key"], 
+                                                             item["status"] == "rendered")
+        item["backdrops"] = self.write_backdrop_variants(self.get_stage(), self.cache, item["key"], 
+                                                         item["status"] == "rendered")
+        self.store_light_passes(self.get_stage(), self.cache, item["key"], 
+                                item["status"] == "rendered")
+        item["views"] = self.render_views(self.get_stage(), self.cache, item["key"])
+        self.add_to_atlas(item["object"], item["preview"])
+    except Exception as e:
+      error = str(e)
+    if len(error) > 0:
+      item["status"] = "failed"
+      item["error"] = error
+
+    item["seconds"] = round(time.perf_counter() - item.pop("start"), 3)
+    del item["key"]
+    self.results.append(item)
+    preview_stats.end_asset(item["status"])
+    render_queue.item_done(item["seconds"], failed=item["status"] == "failed")
+    print(f"[{render_queue.done}/{render_queue.total}] {item['object']}: {item['status']} {item['seconds']:.2f}s")
+
+  def finish(self, context):
+    wm = context.window_manager
+    wm.event_timer_remove(self._timer)
+    context.preferences.view.render_display_type = self.render_display_type
+
+    start = render_queue.start
+    render_queue.reset()
+    self.finish_batch(context, self.get_stage(), self.cache, self.results, start)
+    self.redraw(context)
+    return {'FINISHED'}
+
+  def redraw(self, context):
+    for area in context.screen.areas:
+      if area.type == 'VIEW_3D':
+        area.tag_redraw()
+
+
+class OBJECT_OT_NXQueuePause(Operator):
+  bl_idname = "object.nx_queue_pause"
+  bl_label = "Pause Render Queue"
+  bl_description = "Pause or resume the render queue, the current render is finished"
+  bl_options = {"INTERNAL"}
+
+  @classmethod
+  def poll(cls, context):
+    return render_queue.running
+
+  def execute(self, context):
+    render_queue.paused = not render_queue.paused
+    return {'FINISHED'}
+
+
+class OBJECT_OT_NXQueueCancel(Operator):
+  bl_idname = "object.nx_queue_cancel"
+  bl_label = "Cancel Render Queue"
+  bl_description = "Stop the render queue after the current render, the previews done are kept"
+  bl_options = {"INTERNAL"}
+
+  @classmethod
+  def poll(cls, context):
+    return render_queue.running
+
+  def execute(self, context):
+    render_queue.cancel_requested = True
+    return {'FINISHED'}
+
+
+class OBJECT_OT_NXStageClear(Operator, NXBase):
+  bl_idname = "object.nx_stage_clear"
+  bl_label = "Clear Preview Stage"
+  bl_description = "Remove the preview scene kept between renders"
+  bl_options = {"INTERNAL"}
+
+  @classmethod
+  def poll(cls, context):
+    return cls.scene_preview in bpy.data.scenes and not render_queue.running
+
+  def execute(self, context):
+    if context.scene.name == self.scene_preview:
+      scenes = [s for s in bpy.data.scenes if s.name != self.scene_preview]
+      if len(scenes) > 0 and context.window is not None:
+        context.window.scene = scenes[0]
+    self.clear_stage()
+
+    self.report({'INFO'}, "Preview stage cleared")
+    return {'FINISHED'}
+
+
+class OBJECT_OT_NXPurgeOrphans(Operator):
+  bl_idname = "object.nx_purge_orphans"
+  bl_label = "Purge Orphan Data"
+  bl_description = "Remove all the meshes, lights, cameras, node groups, worlds and images without users.\nThe data of the preview stage are kept"
+  bl_options = {"INTERNAL", "UNDO"}
+
+  def execute(self, context):
+    removed = purge_orphan_data()
+    self.report({'INFO'}, f"{removed} orphan datablocks removed")
+    return {'FINISHED'}
+
+
+class OBJECT_OT_NXResourcesReload(Operator):
+  bl_idname = "object.nx_resources_reload"
+  bl_label = "Reload Preview Resources"
+  bl_description = "Load again the backdrop node group and the world image kept for the session"
+  bl_options = {"INTERNAL"}
+
+  def execute(self, context):
+    reloaded = reload_resources()
+    self.report({'INFO'}, f"{reloaded} preview resources reloaded")
+    return {'FINISHED'}
+
+
+class OBJECT_OT_NXRelight(Operator):
+  bl_idname = "object.nx_relight"
+  bl_label = "Relight Preview"
+  bl_description = "Set the preview with the current strengths of the lights and the world, without render"
+  bl_options = {"INTERNAL"}
+
+  @classmethod
+  def poll(cls, context):
+    return context.object is not None
+
+  def execute(self, context):
+    if not relight_preview(context.object, context.scene.NXPreview):
+      self.report({'WARNING'}, "No light passes, render the preview with Relight Passes and Cycles")
+      return {'CANCELLED'}
+    return {'FINISHED'}
+
+
+class OBJECT_OT_NXCacheClean(Operator):
+  bl_idname = "object.nx_cache_clean"
+  bl_label = "Clean Preview Cache"
+  bl_description = "Remove the previews of the cache older or over the size limit"
+  bl_options = {"INTERNAL"}
+
+  max_size : IntProperty(
+    default=1024,
+    min=0
+  )
+  max_days : IntProperty(
+    default=30,
+    min=0
+  )
+  clear_all : BoolProperty(
+    default=False
+  )
+
+  def execute(self, context):
+    cache = PreviewCache(managed_cache_dir())
+    if self.clear_all:
+      removed, freed = cache.clear()
+    else:
+      removed, freed = cache.evict(self.max_size * 1024 * 1024, self.max_days * 24 * 3600)
+    cache.save()
+
+    self.report({'INFO'}, 
+                f"{removed} previews removed, {freed / 1024 / 1024:.1f} MB freed, "
+                f"{cache.size() / 1024 / 1024:.1f} MB in cache")
+    return {'FINISHED'}
@@ -0,0 +1,105 @@
+'''Render queue shared by the queue operator, the render handlers and the panel'''
+import time
+from collections import deque
+import bpy
+from bpy.app.handlers import persistent
+
+
+class RenderQueue:
+  '''FIFO of the objects to render and state of the current render.
+  state is IDLE, RENDERING (render job running), COMPLETE or CANCELLED (render job ended)'''
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.pending = deque()
+    self.running = False
+    self.paused = False
+    self.cancel_requested = False
+    self.state = "IDLE"
+    self.scene = ""
+    self.current = ""
+    self.total = 0
+    self.done = 0
+    self.failed = 0
+    self.seconds = []
+    self.start = time.perf_counter()
+
+  def begin(self, object_names, scene_name):
+    self.reset()
+    self.running = True
+    self.scene = scene_name
+    self.extend(object_names)
+
+  def extend(self, object_names):
+    '''Add the objects not already waiting, return the number added'''
+    names = [n for n in object_names if n not in self.pending and n != self.current]
+    self.pending.extend(names)
+    self.total += len(names)
+    return len(names)
+
+  def next(self):
+    self.current = self.pending.popleft()
+    return self.current
+
+  def item_done(self, seconds, failed=False):
+    self.done += 1
+    self.current = ""
+    if failed:
+      self.failed += 1
+    else:
+      self.seconds.append(seconds)
+
+  def eta(self):
+    '''Seconds left, from the mean time of the previews already done'''
+    if len(self.seconds) == 0:
+      return None
+    return sum(self.seconds) / len(self.seconds) * (len(self.pending) + (1 if self.current else 0))
+
+  def status(self):
+    text = f"{self.done}/{self.total}"
+    eta = self.eta()
+    if self.paused:
+      text += " paused"
+    elif eta is not None:
+      text += f" ETA {int(eta) // 60}:{int(eta) % 60:02d}"
+    return text
+
+
+render_queue = RenderQueue()
+
+
+@persistent
+def on_render_complete(scene, depsgraph=None):
+  if render_queue.state == "RENDERING" and scene.name == render_queue.scene:
+    render_queue.state = "COMPLETE"
+
+
+@persistent
+def on_render_cancel(scene, depsgraph=None):
+  if render_queue.state == "RENDERING" and scene.name == render_queue.scene:
+    render_queue.state = "CANCELLED"
+
+
+@persistent
+def on_load_pre(*args):
+  '''The queue operator doesn't survive to the loading of a file'''
+  render_queue.reset()
+
+
+def register_handlers():
+  if on_load_pre not in bpy.app.handlers.load_pre:
+    bpy.app.handlers.load_pre.append(on_load_pre)
+  if on_render_complete not in bpy.app.handlers.render_complete:
+    bpy.app.handlers.render_complete.append(on_render_complete)
+  if on_render_cancel not in bpy.app.handlers.render_cancel:
+    bpy.app.handlers.render_cancel.append(on_render_cancel)
+
+
+def unregister_handlers():
+  if on_load_pre in bpy.app.handlers.load_pre:
+    bpy.app.handlers.load_pre.remove(on_load_pre)
+  if on_render_complete in bpy.app.handlers.render_complete:
+    bpy.app.handlers.render_complete.remove(on_render_complete)
+  if on_render_cancel in bpy.app.handlers.render_cancel:
+    bpy.app.handlers.render_cancel.remove(on_render_cancel)
@@ -0,0 +1,68 @@
+'''Relight of the previews from the light group passes, without render.
+
+With Cycles and light groups (Blender 3.2+), each light of the stage and the
+world are in their own light group and their contribution is written in a pass.
+The passes are kept at the size of the thumbnail in a .npz file by object, with
+the strengths of the render. The light is additive: a new combination of the
+strengths is a weighted sum of the passes, computed in milliseconds.
+A light rendered with a strength of 0 has no pass and can't be relit.
+'''
+import os
+import numpy as np
+from . nxpixels import alpha_over, linear_to_srgb, set_preview_pixels
+
+PREFIX = "NX_"
+PASSES_KEY = "nx_light_passes"
+
+# light group: strength setting
+LIGHT_GROUPS = {
+  "Area_1": "light_top_strength",
+  "Area_2": "light_left_strength",
+  "Area_3": "light_right_strength",
+  "World": "world_strength"
+}
+
+
+def lightgroups_supported(view_layer):
+  return hasattr(view_layer, "lightgroups")
+
+
+def get_strengths(settings):
+  return {group: getattr(settings, setting) for group, setting in LIGHT_GROUPS.items()}
+
+
+def save_passes(filepath, passes, alpha, strengths):
+  '''Write the RGB passes (height, width, 3) by light group, the alpha and the strengths'''
+  np.savez_compressed(filepath, alpha=alpha,
+                      strengths=np.array([strengths[group] for group in LIGHT_GROUPS]),
+                      **passes)
+
+
+def load_passes(filepath):
+  with np.load(filepath) as data:
+    passes = {group: data[group] for group in LIGHT_GROUPS}
+    strengths = dict(zip(LIGHT_GROUPS, data["strengths"].tolist()))
+    return passes, data["alpha"], strengths
+
+
+def relight(passes, alpha, rendered, strengths):
+  '''Premultiplied linear RGBA pixels lit with strengths'''
+  rgb = np.zeros_like(next(iter(passes.values())))
+  for group, pixels in passes.items():
+    if rendered[group] > 0:
+      rgb += pixels * (strengths[group] / rendered[group])
+  return np.concatenate((rgb, alpha[..., None]), axis=-1)
+
+
+def relight_preview(obj, settings):
+  '''Set the preview of obj lit with the strengths of settings,
+  return False if the object has no passes'''
+  filepath = obj.get(PASSES_KEY, "")
+  if not os.path.isfile(filepath):
+    return False
+  passes, alpha, rendered = load_passes(filepath)
+  pixels = relight(passes, alpha, rendered, get_strengths(settings))
+  if settings.use_background:
+    pixels = alpha_over(pixels, settings.background_color)
+  set_preview_pixels(obj, linear_to_srgb(pixels))
+  return True
@@ -0,0 +1,104 @@
+'''Fixed resources of the preview stage, loaded once and kept for the session.
+
+The backdrop node group (appended from GNX_Backdrop.blend) and the world
+image (city.exr studio light) are pinned with a fake user and tagged with a
+key made of RESOURCES_VERSION and the path and date of their source file.
+A resource with another key is loaded again, reload_resources() forces it.
+release_resources() removes them with the stage, eg before a file is saved.
+'''
+import os
+import bpy
+
+# change it when the resources change to load them again
+RESOURCES_VERSION = 1
+KEY = "nx_resource"
+
+BACKDROP_GROUP = "GNX_Backdrop"
+BACKDROP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "GNX_Backdrop.blend")
+WORLD_IMAGE = "city.exr"
+
+# resource name: name of the datablock in bpy.data
+session_resources = {}
+
+
+def source_key(filepath):
+  mtime = int(os.path.getmtime(filepath)) if os.path.isfile(filepath) else 0
+  return f"{RESOURCES_VERSION}:{filepath}:{mtime}"
+
+
+def find_resource(collection, resource, key):
+  '''Datablock of the resource with key, from the session then from the file'''
+  id_data = collection.get(session_resources.get(resource, ""))
+  if id_data is not None and id_data.get(KEY) == key:
+    return id_data
+  for id_data in collection:
+    if id_data.get(KEY) == key:
+      session_resources[resource] = id_data.name
+      return id_data
+  return None
+
+
+def pin(id_data, resource, key):
+  id_data.use_fake_user = True
+  id_data[KEY] = key
+  session_resources[resource] = id_data.name
+  return id_data
+
+
+def world_image_path():
+  return bpy.context.preferences.studio_lights[WORLD_IMAGE].path
+
+
+def get_backdrop_group():
+  key = source_key(BACKDROP_FILE)
+  node_group = find_resource(bpy.data.node_groups, BACKDROP_GROUP, key)
+  if node_group is not None:
+    return node_group
+
+  with bpy.data.libraries.load(BACKDROP_FILE, link=False) as (data_from, data_to):
+    data_to.node_groups = [name for name in data_from.node_groups if name == BACKDROP_GROUP]
+  print(f"NX_Preview: {BACKDROP_GROUP} appended")
+  return pin(data_to.node_groups[0], BACKDROP_GROUP, key)
+
+
+def get_world_image():
+  filepath = world_image_path()
+  key = source_key(filepath)
+  image = find_resource(bpy.data.images, WORLD_IMAGE, key)
+  if image is not None:
+    return image
+
+  image = bpy.data.images.load(filepath, check_existing=False)
+  print(f"NX_Preview: {WORLD_IMAGE} loaded")
+  return pin(image, WORLD_IMAGE, key)
+
+
+def release_resources():
+  '''Remove the pinned resources, they are loaded again by the next stage.
+  Return the number of resources removed'''
+  removed = 0
+  for collection in (bpy.data.node_groups, bpy.data.images):
+    for id_data in [d for d in collection if d.get(KEY) is not None]:
+      collection.remove(id_data, do_unlink=True)
+      removed += 1
+  session_resources.clear()
+  return removed
+
+
+def reload_resources():
+  '''Load the resources again and replace the old ones where they are used.
+  Return the number of resources reloaded'''
+  reloaded = 0
+  for collection, resource, getter in ((bpy.data.node_groups, BACKDROP_GROUP, get_backdrop_group),
+                                       (bpy.data.images, WORLD_IMAGE, get_world_image)):
+    # one resource by collection
+    old = [id_data for id_data in collection if id_data.get(KEY) is not None]
+    for id_data in old:
+      del id_data[KEY]
+    session_resources.pop(resource, None)
+    new = getter()
+    for id_data in old:
+      id_data.user_remap(new)
+      collection.remove(id_data, do_unlink=True)
+    reloaded += 1
+  return reloaded
@@ -0,0 +1,152 @@
+'''Time of each stage of the preview pipeline, by asset.
+
+The operators open a run, an asset record for each object and time the stages
+with the stage() context manager. The stages timed outside of an asset (stage
+build) are kept for the run. At the end of the run, a summary is computed for
+the panel and the records are written to a JSON or CSV log.
+'''
+import csv
+import json
+import re
+import sys
+import time
+from contextlib import contextmanager
+import bpy
+from bpy.app.handlers import persistent
+
+RENDER_PEAK = re.compile(r"Peak[: ]+([\d.]+)\s*M")
+
+
+def peak_memory_mb():
+  '''Peak memory of the Blender process, 0 if unknown (Windows)'''
+  try:
+    import resource
+  except ImportError:
+    return 0.0
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # bytes on macOS, kilobytes on Linux
+  return round(peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024, 1)
+
+
+class PreviewStats:
+  def __init__(self):
+    self.begin_run()
+    self.summary = None
+
+  def begin_run(self):
+    self.start = time.perf_counter()
+    self.assets = {}
+    self.run_stages = {}
+    self.current = ""
+    self.render_stats = ""
+
+  def begin_asset(self, object_name):
+    self.current = object_name
+    self.render_stats = ""
+    self.assets[object_name] = {
+      "object": object_name,
+      "status": "",
+      "seconds": 0.0,
+      "peak_memory_mb": 0.0,
+      "render_peak_mb": 0.0,
+      "render_stats": "",
+      "stages": {},
+      "start": time.perf_counter()
+    }
+
+  def add_stage(self, name, seconds, object_name=None):
+    record = self.assets.get(object_name or self.current)
+    stages = record["stages"] if record is not None else self.run_stages
+    stages[name] = round(stages.get(name, 0.0) + seconds, 4)
+
+  @contextmanager
+  def stage(self, name, object_name=None):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.add_stage(name, time.perf_counter() - start, object_name)
+
+  @contextmanager
+  def shared_stage(self, name, object_names):
+    '''Time a stage done once for several assets, split evenly between them'''
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      seconds = time.perf_counter() - start
+      names = [n for n in object_names if n in self.assets]
+      if len(names) == 0:
+        self.add_stage(name, seconds)
+      for object_name in names:
+        self.add_stage(name, seconds / len(names), object_name)
+
+  def end_asset(self, status):
+    record = self.assets.get(self.current)
+    if record is None:
+      return
+    record["status"] = status
+    record["seconds"] = round(time.perf_counter() - record.pop("start"), 3)
+    record["peak_memory_mb"] = peak_memory_mb()
+    record["render_stats"] = self.render_stats
+    match = RENDER_PEAK.search(self.render_stats)
+    if match is not None:
+      record["render_peak_mb"] = float(match.group(1))
+    self.current = ""
+
+  def end_run(self, log_path=""):
+    '''Compute the summary of the run and write the log'''
+    records = list(self.assets.values())
+    for record in records:
+      record.pop("start", None)
+    stages = dict(self.run_stages)
+    for record in records:
+      for name, seconds in record["stages"].items():
+        stages[name] = round(stages.get(name, 0.0) + seconds, 4)
+
+    seconds = round(time.perf_counter() - self.start, 3)
+    self.summary = {
+      "assets": len(records),
+      "seconds": seconds,
+      "mean": round(seconds / len(records), 3) if len(records) > 0 else 0.0,
+      "peak_memory_mb": peak_memory_mb(),
+      "stages": dict(sorted(stages.items(), key=lambda s: -s[1])),
+      "slowest": [(r["object"], r["seconds"])
+                    for r in sorted(records, key=lambda r: -r["seconds"])[:5]]
+    }
+    if len(log_path) > 0:
+      self.write_log(bpy.path.abspath(log_path), records)
+    return self.summary
+
+  def write_log(self, log_path, records):
+    if log_path.lower().endswith(".csv"):
+      stage_names = sorted({name for r in records for name in r["stages"]})
+      with open(log_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["object", "status", "seconds", "peak_memory_mb", "render_peak_mb"] + stage_names)
+        for r in records:
+          writer.writerow([r["object"], r["status"], r["seconds"], r["peak_memory_mb"], r["render_peak_mb"]] +
+                          [r["stages"].get(name, 0.0) for name in stage_names])
+    else:
+      with open(log_path, "w") as f:
+        json.dump({"summary": self.summary, "run_stages": self.run_stages, "assets": records}, f, indent=2)
+    print(f"NX_Preview: stats written in {log_path}")
+
+
+preview_stats = PreviewStats()
+
+
+@persistent
+def on_render_stats(stats):
+  '''Last statistics line of the render engine, memory and time'''
+  preview_stats.render_stats = stats
+
+
+def register_handlers():
+  if on_render_stats not in bpy.app.handlers.render_stats:
+    bpy.app.handlers.render_stats.append(on_render_stats)
+
+
+def unregister_handlers():
+  if on_render_stats in bpy.app.handlers.render_stats:
+    bpy.app.handlers.render_stats.remove(on_render_stats)
@@ -0,0 +1,112 @@
+'''Manifest of an asset library, to save again only the new or changed assets.
+
+The manifest (.nx_manifest.json in the library folder) stores for each asset
+the file where it's saved, the hash of its data and of its preview and the
+modification time of the file when it was written. A file is written again if
+one of its assets changed, if its assets changed or if it was modified outside
+of the addon. Only the files listed in the manifest can be removed.
+'''
+import hashlib
+import json
+import os
+import numpy as np
+from . nxcache import asset_key
+
+MANIFEST_NAME = ".nx_manifest.json"
+MANIFEST_VERSION = 1
+
+
+def asset_metadata(obj):
+  asset_data = obj.asset_data
+  return {
+    "name": obj.name,
+    "catalog_id": asset_data.catalog_id,
+    "description": asset_data.description,
+    "author": getattr(asset_data, "author", ""),
+    "tags": sorted(tag.name for tag in asset_data.tags)
+  }
+
+
+def data_hash(obj, obj_eval, apply_modifiers=False):
+  '''Hash of the evaluated mesh, its materials and the asset metadata'''
+  return asset_key(obj_eval, {"asset": asset_metadata(obj), "apply_modifiers": apply_modifiers})
+
+
+def preview_hash(id_data):
+  '''Hash of the pixels of the preview, empty if there is none'''
+  preview = id_data.preview
+  if preview is None:
+    return ""
+  width, height = preview.image_size
+  pixels = np.empty(width * height * 4, dtype=np.float32)
+  preview.image_pixels_float.foreach_get(pixels)
+  return hashlib.sha1(pixels.tobytes()).hexdigest()
+
+
+class LibraryManifest:
+  '''Assets saved in a library folder, by asset name'''
+  def __init__(self, directory):
+    self.directory = directory
+    self.manifest_path = os.path.join(directory, MANIFEST_NAME)
+    self.assets = {}
+    if os.path.isfile(self.manifest_path):
+      try:
+        with open(self.manifest_path) as f:
+          manifest = json.load(f)
+        if manifest.get("version") == MANIFEST_VERSION:
+          self.assets = manifest["assets"]
+      except (ValueError, KeyError):
+        print(f"NX_Preview: invalid library manifest {self.manifest_path}, ignored")
+
+  def file_path(self, file_name):
+    return os.path.join(self.directory, f"{file_name}.blend")
+
+  def file_mtime(self, file_name):
+    filepath = self.file_path(file_name)
+    return round(os.path.getmtime(filepath), 3) if os.path.isfile(filepath) else 0.0
+
+  def is_changed(self, file_name, names, hashes):
+    '''Return True if the file must be written for the assets names'''
+    mtime = self.file_mtime(file_name)
+    if mtime == 0.0:
+      return True
+    saved = {name for name, entry in self.assets.items() if entry["file"] == file_name}
+    if saved != set(names):
+      return True
+    for name in names:
+      entry = self.assets[name]
+      if (entry["data"] != hashes[name]["data"] or
+          entry["preview"] != hashes[name]["preview"] or
+          entry["mtime"] != mtime):
+        return True
+    return False
+
+  def update(self, file_name, names, hashes):
+    '''Record the assets names written in the file'''
+    for name in [n for n, e in self.assets.items() if e["file"] == file_name]:
+      del self.assets[name]
+    mtime = self.file_mtime(file_name)
+    for name in names:
+      self.assets[name] = {
+        "file": file_name,
+        "data": hashes[name]["data"],
+        "preview": hashes[name]["preview"],
+        "mtime": mtime
+      }
+
+  def stale_files(self, file_names):
+    '''Files of the manifest without asset to save'''
+    return sorted({e["file"] for e in self.assets.values()} - set(file_names))
+
+  def remove_file(self, file_name):
+    for name in [n for n, e in self.assets.items() if e["file"] == file_name]:
+      del self.assets[name]
+    filepath = self.file_path(file_name)
+    if os.path.isfile(filepath):
+      os.remove(filepath)
+
+  def save(self):
+    tmp_path = f"{self.manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+      json.dump({"version": MANIFEST_VERSION, "assets": self.assets}, f, indent=1)
+    os.replace(tmp_path, self.manifest_path)
@@ -0,0 +1,81 @@
+'''Write-behind of the asset files of the library.
+
+Blender writes the .blend files in a local folder, on the main thread, this is
+fast. A helper thread copies them to the library, often on a network share, so
+the next render doesn't wait for the storage. The queue is bounded: submit()
+blocks when too many files are waiting (backpressure). flush() waits until all
+the files are in the library and returns the failed copies.
+'''
+import atexit
+import os
+import queue
+import shutil
+import tempfile
+import threading
+
+MAX_PENDING = 8
+
+
+class LibraryWriter:
+  def __init__(self, max_pending=MAX_PENDING):
+    self.jobs = queue.Queue(maxsize=max_pending)
+    self.lock = threading.Lock()
+    self.thread = None
+    self.local_dir = ""
+    self.failures = []
+    self.written = 0
+
+  @property
+  def pending(self):
+    return self.jobs.unfinished_tasks
+
+  def local_path(self):
+    '''New path in the local folder, to write a file with Blender'''
+    if not os.path.isdir(self.local_dir):
+      self.local_dir = tempfile.mkdtemp(prefix="nx_preview_write_")
+    fd, path = tempfile.mkstemp(suffix=".blend", dir=self.local_dir)
+    os.close(fd)
+    return path
+
+  def submit(self, local_path, filepath):
+    '''Copy the local file to filepath in the background, then remove it'''
+    if self.thread is None or not self.thread.is_alive():
+      self.thread = threading.Thread(target=self.run, name="NXLibraryWriter", daemon=True)
+      self.thread.start()
+    self.jobs.put((local_path, filepath))
+
+  def run(self):
+    while True:
+      local_path, filepath = self.jobs.get()
+      try:
+        # the library file is replaced at once, never seen half written
+        part_path = f"{filepath}.part"
+        shutil.copyfile(local_path, part_path)
+        os.replace(part_path, filepath)
+        with self.lock:
+          self.written += 1
+      except OSError as e:
+        print(f"NX_Preview: {filepath} not saved: {e}")
+        with self.lock:
+          self.failures.append((filepath, str(e)))
+      finally:
+        if os.path.isfile(local_path):
+          os.remove(local_path)
+        self.jobs.task_done()
+
+  def take_failures(self):
+    '''Failed copies since the last call, without waiting'''
+    with self.lock:
+      failures, self.failures = self.failures, []
+    return failures
+
+  def flush(self):
+    '''Wait until all the submitted files are copied, return the failures'''
+    self.jobs.join()
+    return self.take_failures()
+
+
+library_writer = LibraryWriter()
+
+# the files submitted are copied before Blender quits
+atexit.register(library_writer.flush)